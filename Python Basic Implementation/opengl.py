@@ -1,12 +1,14 @@
 import sys 
-import numpy as np
 import OpenGL.GL as gl
 import OpenGL.GLUT as glut
 from particleCode import *
-import math
+from particleRaster import FrameBuffer, rasterize
+from particlePipeline import FrameRing, SimulationProducer
+from particleRecorder import TrajectoryReader, TrajectoryReplay
 
 # define size of image
 width, height = 512, 512
+framebuffer = FrameBuffer(width, height)
 
 listofparticles = initialiseArray()
 atomic = AtomicCounter()
@@ -16,63 +18,41 @@ brightnessspeed = False # Key 2
 centermass = False # Key 4
 rendertext = ""
 
-def draw():
-    global image, width, height, listofparticles
-    particlecolour = 0 # Red by default
-
-    if gravityhalt == True:
+# The simulation runs on its own thread and hands frames to the display through a ring of slots
+# targetsimulationrate - steps per second, 60 keeps the old pace of about one step per displayed
+#                        frame, None steps as fast as possible
+# dropframes           - True shows only the newest step, False makes the simulation wait for the display
+# frameslots           - 3 lets simulation and display run without waiting on each other
+targetsimulationrate = 60
+dropframes = True
+frameslots = 3
+framering = FrameRing(len(listofparticles), listofparticles.positions.dtype, frameslots, dropframes)
+
+def simulate():
+    # One simulation step, runs on the producer thread
+    global listofparticles
+    halted = gravityhalt
+    if halted == True:
         listofparticles = gravstopmethod(listofparticles)
-        particlecolour = 2 # Blue
     else:
         listofparticles = mainmovementandcollisions(atomic, listofparticles)
+    return listofparticles, halted
+
+simulation = SimulationProducer(framering, simulate, targetsimulationrate)
+
+# Set when viewing a recording instead of a live simulation (--replay)
+replay = None
+replayrate = 60
+
+def draw():
+    # Takes the latest completed frame, the simulation keeps stepping meanwhile
+    frame = framering.acquire()
+    if frame is None:
+        framebuffer.clear()
+        return
 
-    for particle in listofparticles:
-        particleX = particle._x
-        particleY = particle._y
-        particlebrightness = 255
-
-        if solidcolour == True:
-            particlecolour = 1 # Green
-
-        if centermass == True:
-            centerX = height / 2
-            centerY = width / 2
-            tempX = 0
-            tempY = 0
-            radius = height / 2
-            additionalradius = 30 # allows center of mass to be further out
-
-
-            tempX = centerX - particleX
-            tempY = centerY - particleY
-
-            hypotenuse = (tempX * tempX) + (tempY * tempY)
-            hypotenuse = math.sqrt(hypotenuse)
-
-            if hypotenuse > (radius - additionalradius):                   
-                #print("continue")
-                continue
-
-            particlebrightness = 255 - (hypotenuse + additionalradius)    
-            
-        if brightnessspeed == True:
-            particlecolour = 1 # Green
-            if particle._vx and particle._vy == 1:
-                particlebrightness = 120
-            elif particle._vx and particle._vy == 2: 
-                particlebrightness = 180
-            elif particle._vx and particle._vy == 3:
-                particlebrightness = 255
-            elif particle._vx and particle._vy == 0:
-                particlebrightness = 75
-            elif particle._vx or particle._vy == 3:
-                particlebrightness = 220
-            elif particle._vx or particle._vy == 2:
-                particlebrightness = 150
-            elif particle._vx or particle._vy == 1:
-                particlebrightness = 90
-
-        image[particleX][particleY][particlecolour] = particlebrightness
+    # Colour modes are computed for every particle at once and scattered into the reused buffer
+    rasterize(framebuffer, frame.positions, frame.velocities, solidcolour, brightnessspeed, centermass, frame.gravityhalt)
 
 def render_string(text: str, x: int, y: int):
     gl.glColor3f(1, 1, 1)
@@ -83,9 +63,6 @@ def render_string(text: str, x: int, y: int):
 
 def displayCallback():    
     start_time = time.time()
-    global image, width, height, listofparticles
-    image = np.zeros((width, height, 4), dtype=np.ubyte)
-
     draw()
     
     gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
@@ -93,11 +70,18 @@ def displayCallback():
 
     # Draw image
     gl.glRasterPos2i(-1, -1)
-    gl.glDrawPixels(width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, image)
+    gl.glDrawPixels(width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, framebuffer.image)
     render_string(rendertext, 0, 0)
     glut.glutSwapBuffers()
     print("FPS: ", 1.0 / (time.time() - start_time))
 
+def idleCallback():
+    # Only redraw once the simulation has published something new
+    if framering.hasNew():
+        glut.glutPostRedisplay()
+    else:
+        time.sleep(0.001)
+
 def reshapeCallback(width, height):
     gl.glClearColor(1, 1, 1, 1)
     gl.glViewport(0, 0, width, height)
@@ -110,8 +94,12 @@ def keyboardCallback(key, x, y):
     global gravityhalt, solidcolour, brightnessspeed, centermass, rendertext
     
     if key == b'\033':
+      simulation.stop()
+      closeEngine()
       sys.exit( )
     elif key == b'q':
+      simulation.stop()
+      closeEngine()
       sys.exit( )   
     elif key == b'g':
         if gravityhalt == False:
@@ -141,6 +129,15 @@ def keyboardCallback(key, x, y):
             centermass = False
     elif key == b'3':        
         rendertext = "Sorry key 3 not implemented"
+    elif replay is not None and key == b' ':
+        replay.paused = not replay.paused
+        rendertext = "Paused" if replay.paused else ""
+    elif replay is not None and key == b'[':
+        replay.seek(replay.current - replayrate)
+    elif replay is not None and key == b']':
+        replay.seek(replay.current + replayrate)
+    elif replay is not None and key == b'r':
+        replay.seek(0)
     elif key == b'4':
         if centermass == False:
             rendertext = "4 - Center Mass"
@@ -165,6 +162,16 @@ def keyboardUpCallback(key, x, y):
 
 
 if __name__ == "__main__":
+    # python opengl.py --replay run.ptrj plays a recording back
+    # space pauses, [ and ] seek a second back/forward, r restarts
+    if len(sys.argv) > 2 and sys.argv[1] == "--replay":
+        reader = TrajectoryReader(sys.argv[2])
+        if len(reader) == 0:
+            sys.exit("No frames in " + sys.argv[2])
+        replay = TrajectoryReplay(reader)
+        framering = FrameRing(reader.numberofparticles, reader.dtype, frameslots, dropframes)
+        simulation = SimulationProducer(framering, replay.step, replayrate)
+
     glut.glutInit()
     glut.glutInitDisplayMode(glut.GLUT_DOUBLE | glut.GLUT_RGBA | 
     glut.GLUT_DEPTH)
@@ -172,11 +179,9 @@ if __name__ == "__main__":
     glut.glutInitWindowPosition(704, 259)
     glut.glutCreateWindow('Python particles simulator')
     glut.glutDisplayFunc(displayCallback)
-    glut.glutIdleFunc(displayCallback)
+    glut.glutIdleFunc(idleCallback)
     glut.glutReshapeFunc(reshapeCallback)
     glut.glutKeyboardFunc(keyboardCallback)
     glut.glutKeyboardUpFunc(keyboardUpCallback)
-
-    #   Create image
-    image = np.zeros((width, height, 4), dtype=np.ubyte)
+    simulation.start()
     glut.glutMainLoop()
\ No newline at end of file
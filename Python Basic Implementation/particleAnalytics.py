@@ -0,0 +1,189 @@
+import csv
+import os
+import struct
+import time
+import numpy as np
+
+# On-the-fly analytics computed from the step arrays, no pass over recorded trajectories needed
+#
+# Every sample holds:
+#   density grid      - particles per block of cellsize x cellsize cells
+#   kinetic energy    - 0.5 * sum(v^2), in total and per axis
+#   collision rate    - collisions per frame since the previous sample
+#   radial histogram  - particles per ring around the center mass point of opengl.py,
+#                       plus the count divided by ring area
+#
+# The density grid is one bincount over the particles' blocks, which costs about as much as
+# finding the particles that changed block would. Everything else is one array pass too, and
+# samples are only taken every nth frame, so the overhead is bounded by the cadence.
+#
+# Samples go to a rolling CSV (rotated to path.1 after maxrecords rows, without the grid) or to
+# a binary ring log holding the last maxrecords samples, grid included, see readAnalyticsLog.
+
+logmagic = b"PTAN"
+logversion = 1
+# magic, version, grid width, grid height, radial bins, ring size, samples written
+logheaderformat = "<4sIIIIQQ"
+logheadersize = 64
+
+def recordDtype(gridwidth, gridheight, radialbins):
+    return np.dtype([
+        ("frame", "<i8"),
+        ("time", "<f8"),
+        ("collisions", "<i8"),
+        ("collisionrate", "<f8"),
+        ("kineticenergy", "<f8"),
+        ("kineticenergyx", "<f8"),
+        ("kineticenergyy", "<f8"),
+        ("radial", "<i8", (radialbins,)),
+        ("density", "<i4", (gridwidth, gridheight)),
+    ])
+
+def readAnalyticsLog(path):
+    # Samples of a binary log in the order they were taken, oldest first
+    with open(path, "rb") as log:
+        header = log.read(logheadersize)
+    if len(header) < logheadersize or header[:4] != logmagic:
+        raise ValueError("%s is not an analytics log" % path)
+    filemagic, version, gridwidth, gridheight, radialbins, ringsize, written = struct.unpack_from(logheaderformat, header)
+    if version != logversion:
+        raise ValueError("unsupported analytics log version %d" % version)
+    dtype = recordDtype(gridwidth, gridheight, radialbins)
+    count = min(written, ringsize)
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    records = np.fromfile(path, dtype=dtype, count=count, offset=logheadersize)
+    # Once the ring has wrapped the oldest sample sits right after the newest one
+    return np.roll(records, -(written % ringsize)) if written > ringsize else records
+
+class Analytics(object):
+    # boundary    - simulation boundary, sets the grid and radial range
+    # every       - only sample every nth call to update, 1 samples them all
+    # cellsize    - side of one density grid block in cells
+    # radialbins  - rings in the radial histogram
+    # centre      - (x, y) of the radial histogram, defaults to the center mass point
+    # path        - ".csv" for the rolling CSV, anything else for the binary ring log
+    # maxrecords  - rows per CSV file or samples kept by the binary log
+    def __init__(self, boundary, every=1, cellsize=16, radialbins=32, centre=None, path=None, maxrecords=100000):
+        self.boundary = boundary
+        self.every = max(1, int(every))
+        self.cellsize = max(1, int(cellsize))
+        self.gridwidth = boundary // self.cellsize + 1
+        self.density = np.zeros((self.gridwidth, self.gridwidth), dtype=np.int32)
+        self.centre = ((boundary + 1) / 2, (boundary + 1) / 2) if centre is None else centre
+        # The whole grid fits inside the largest ring
+        self.radius = float(np.hypot(max(self.centre[0], boundary - self.centre[0]), max(self.centre[1], boundary - self.centre[1])))
+        self.radialedges = np.linspace(0.0, self.radius, radialbins + 1)
+        self.ringareas = np.pi * np.diff(self.radialedges ** 2)
+        self.maxrecords = max(1, int(maxrecords))
+
+        self.calls = 0
+        self.latest = None
+        self._lastframe = None
+        self._lastcollisions = 0
+
+        self.path = path
+        self._file = None
+        self._writer = None
+        self._rows = 0
+        self._written = 0
+        self._record = None
+        if path is not None:
+            self.open()
+
+    def open(self):
+        if self.path.endswith(".csv"):
+            self._file = open(self.path, "w", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.columns())
+        else:
+            self._record = np.zeros(1, dtype=recordDtype(self.gridwidth, self.gridwidth, len(self.ringareas)))
+            self._file = open(self.path, "w+b")
+            self.writeHeader()
+
+    def columns(self):
+        return ["frame", "time", "collisions", "collisionrate", "kineticenergy", "kineticenergyx", "kineticenergyy", "occupiedblocks", "maxdensity"] + ["radial%d" % ring for ring in range(len(self.ringareas))]
+
+    def writeHeader(self):
+        header = struct.pack(logheaderformat, logmagic, logversion, self.gridwidth, self.gridwidth, len(self.ringareas), self.maxrecords, self._written)
+        self._file.seek(0)
+        self._file.write(header.ljust(logheadersize, b"\0"))
+
+    def callback(self, simulation):
+        # For Simulation.addCallback, the cadence is handled here
+        self.update(simulation.frame, simulation.listofparticles, simulation.atomic.value)
+
+    def update(self, frame, listofparticles, collisions=0):
+        # Returns the new sample, or None when this call is skipped
+        self.calls += 1
+        if (self.calls - 1) % self.every != 0:
+            return None
+        self.updateDensity(listofparticles.positions)
+        sample = self.sample(frame, listofparticles, collisions)
+        self.latest = sample
+        self.export(sample)
+        return sample
+
+    def updateDensity(self, positions):
+        blocks = (positions[:, 0] // self.cellsize).astype(np.int64) * self.gridwidth + positions[:, 1] // self.cellsize
+        self.density.reshape(-1)[...] = np.bincount(blocks, minlength=self.density.size)
+
+    def sample(self, frame, listofparticles, collisions):
+        velocities = listofparticles.velocities.astype(np.int64)
+        energy = 0.5 * np.einsum("ij,ij->j", velocities, velocities)
+        if self._lastframe is None or frame <= self._lastframe:
+            rate = 0.0
+        else:
+            rate = (collisions - self._lastcollisions) / float(frame - self._lastframe)
+        self._lastframe = frame
+        self._lastcollisions = collisions
+
+        positions = listofparticles.positions
+        distance = np.hypot(positions[:, 0] - self.centre[0], positions[:, 1] - self.centre[1])
+        radial = np.histogram(distance, self.radialedges)[0]
+        return {
+            "frame": frame,
+            "time": time.time(),
+            "collisions": collisions,
+            "collisionrate": rate,
+            "kineticenergy": float(energy.sum()),
+            "kineticenergyx": float(energy[0]),
+            "kineticenergyy": float(energy[1]),
+            "radial": radial,
+            "radialdensity": radial / self.ringareas,
+            "density": self.density,
+        }
+
+    def export(self, sample):
+        if self._file is None:
+            return
+        if self._writer is not None:
+            if self._rows >= self.maxrecords:
+                self.rotate()
+            self._writer.writerow([sample["frame"], sample["time"], sample["collisions"], sample["collisionrate"], sample["kineticenergy"], sample["kineticenergyx"], sample["kineticenergyy"], int(np.count_nonzero(self.density)), int(self.density.max())] + sample["radial"].tolist())
+            self._file.flush()
+            self._rows += 1
+            return
+
+        record = self._record[0]
+        for name in ("frame", "time", "collisions", "collisionrate", "kineticenergy", "kineticenergyx", "kineticenergyy", "radial", "density"):
+            record[name] = sample[name]
+        self._file.seek(logheadersize + (self._written % self.maxrecords) * self._record.itemsize)
+        self._file.write(self._record.tobytes())
+        self._written += 1
+        # The count goes in last so a reader never sees a sample that isn't written yet
+        self.writeHeader()
+        self._file.flush()
+
+    def rotate(self):
+        self._file.close()
+        os.replace(self.path, self.path + ".1")
+        self._file = open(self.path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.columns())
+        self._rows = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
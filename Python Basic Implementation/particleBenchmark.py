@@ -0,0 +1,202 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import particleCode
+
+# Only on Unix, without it maxrss and childmaxrss are reported as None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Headless benchmark, no OpenGL needed
+# Runs a fixed number of steps for every combination of particle count, boundary and worker count
+# and writes one JSON object per run so results can be diffed or plotted.
+#
+# Example:
+#   python particleBenchmark.py --particles 1000,100000 --boundary 511,2047 --workers 1,4 --steps 200
+#
+# Steps are timed with nothing else running, tracemalloc alone slows small runs several times.
+# Memory is measured by repeating the run in a fresh process, so peaks of earlier runs in a sweep
+# never carry over:
+#   peakmemory   - largest Python heap use seen by tracemalloc
+#   mappedmemory - particle state held outside the heap, shared memory or memory-mapped files
+#   maxrss       - peak resident set of that process, kilobytes on Linux, None on Windows
+#   childmaxrss  - largest peak of its worker processes, for the process engine, None on Windows
+
+def createEngine(enginename, workers, boundary, collisionmode, backendname="numpy", tilesize=1 << 20):
+    if enginename == "tiled":
+        from particleTiles import TiledEngine
+        if collisionmode != "cell":
+            raise ValueError("the tiled engine only supports cell collision detection")
+        return TiledEngine(boundary, tilesize, backend=backendname)
+    if enginename == "process":
+        from particleProcesses import ProcessEngine
+        return ProcessEngine(workers, boundary, collisionmode=collisionmode, backendname=backendname)
+    return particleCode.ThreadEngine(workers, collisionmode=collisionmode, backend=backendname)
+
+def runSteps(numberofparticles, boundary, workers, steps, gravitysteps, enginename, seed, collisionmode, backendname, compact, tilesize, tracememory=False):
+    # Returns (phases, collisions, memory), memory is empty unless tracememory is set
+    particleCode.boundary = boundary
+    particleCode.numberofparticles = numberofparticles
+    particleCode.compactstorage = compact
+    particles = particleCode.initialiseArray(seed)
+
+    engine = createEngine(enginename, workers, boundary, collisionmode, backendname, tilesize)
+    phases = {"movement": 0.0, "detection": 0.0, "resolution": 0.0, "gravity": 0.0}
+    collisions = 0
+    memory = {}
+
+    if tracememory:
+        tracemalloc.start()
+    try:
+        # ProcessEngine copies the particles into shared memory on attach, TiledEngine onto disk
+        if hasattr(engine, "attach"):
+            particles = engine.attach(particles)
+            memory["mappedmemory"] = particles.positions.nbytes + particles.velocities.nbytes
+        else:
+            memory["mappedmemory"] = 0
+
+        for step in range(steps):
+            start = time.perf_counter()
+            engine.move(particles, boundary)
+            moved = time.perf_counter()
+            groups = engine.detect(particles, boundary)
+            detected = time.perf_counter()
+            collisions += engine.resolve(particles, groups)
+            resolved = time.perf_counter()
+
+            phases["movement"] += moved - start
+            phases["detection"] += detected - moved
+            phases["resolution"] += resolved - detected
+
+        for step in range(gravitysteps):
+            start = time.perf_counter()
+            engine.gravity(particles, boundary)
+            phases["gravity"] += time.perf_counter() - start
+        if tracememory:
+            memory["peakmemory"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracememory:
+            tracemalloc.stop()
+        engine.close()
+
+    if tracememory and resource is not None:
+        memory["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory["childmaxrss"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return phases, collisions, memory
+
+def measureMemory(*arguments):
+    # Runs runSteps with tracing in a new interpreter, returns its memory figures
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(runSteps, *arguments, tracememory=True).result()[2]
+
+def runBenchmark(numberofparticles, boundary, workers, steps, gravitysteps, enginename="thread", seed=0, collisionmode="cell", backendname="numpy", compact=False, tilesize=1 << 20, memory=True):
+    # memory - also repeat the run in a fresh process to measure memory, it takes as long again
+    arguments = (numberofparticles, boundary, workers, steps, gravitysteps, enginename, seed, collisionmode, backendname, compact, tilesize)
+    phases, collisions, measured = runSteps(*arguments)
+    if memory:
+        measured = measureMemory(*arguments)
+
+    steptime = phases["movement"] + phases["detection"] + phases["resolution"]
+    return {
+        "engine": enginename,
+        "collisionmode": collisionmode,
+        "backend": backendname,
+        "compact": compact,
+        "tilesize": tilesize if enginename == "tiled" else None,
+        "numberofparticles": numberofparticles,
+        "boundary": boundary,
+        "workers": workers,
+        "steps": steps,
+        "gravitysteps": gravitysteps,
+        "stepspersecond": steps / steptime if steptime > 0 else None,
+        "phases": phases,
+        "collisions": collisions,
+        "peakmemory": measured.get("peakmemory"),
+        "mappedmemory": measured.get("mappedmemory"),
+        "maxrss": measured.get("maxrss"),
+        "childmaxrss": measured.get("childmaxrss"),
+    }
+
+def runConformance(backendnames, numberofparticles=20000, boundary=511, steps=200, seed=0, collisionmode="cell", compact=False):
+    # Steps every backend from the same seed, with a gravity step every tenth step,
+    # and compares positions and velocities with the first backend after every step
+    # Returns {backend: first step that differed or None}
+    particleCode.boundary = boundary
+    particleCode.numberofparticles = numberofparticles
+    particleCode.compactstorage = compact
+    initial = particleCode.initialiseArray(seed)
+
+    runs = {}
+    for backendname in backendnames:
+        engine = particleCode.ThreadEngine(1, collisionmode=collisionmode, backend=backendname)
+        particles = particleCode.ParticleArray.fromArrays(initial.positions.copy(), initial.velocities.copy())
+        atomic = particleCode.AtomicCounter()
+        trajectory = []
+        for step in range(steps):
+            if step % 10 == 9:
+                engine.gravstopmethod(particles)
+            else:
+                engine.mainmovementandcollisions(atomic, particles)
+            trajectory.append((particles.positions.copy(), particles.velocities.copy()))
+        engine.close()
+        runs[backendname] = trajectory
+
+    reference = runs[backendnames[0]]
+    mismatches = {}
+    for backendname in backendnames:
+        mismatches[backendname] = None
+        for step, (positions, velocities) in enumerate(runs[backendname]):
+            if not (np.array_equal(positions, reference[step][0]) and np.array_equal(velocities, reference[step][1])):
+                mismatches[backendname] = step
+                break
+    return mismatches
+
+def integerList(text):
+    return [int(value) for value in text.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless particle simulation benchmark")
+    parser.add_argument("--particles", type=integerList, default=[1000], help="comma separated particle counts")
+    parser.add_argument("--boundary", type=integerList, default=[511], help="comma separated boundaries")
+    parser.add_argument("--workers", type=integerList, default=[particleCode.numberofworkers], help="comma separated worker counts")
+    parser.add_argument("--engine", choices=["thread", "process", "tiled"], default="thread")
+    parser.add_argument("--collisionmode", choices=["cell", "sweep", "index"], default="cell")
+    parser.add_argument("--backend", choices=sorted(particleCode.backends), default="numpy")
+    parser.add_argument("--tilesize", type=int, default=1 << 20, help="particles per tile for the tiled engine")
+    parser.add_argument("--compact", action="store_true", help="narrowest safe integer storage")
+    parser.add_argument("--conformance", action="store_true", help="check every available backend gives identical trajectories and exit")
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--gravitysteps", type=int, default=None, help="defaults to a tenth of --steps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nomemory", action="store_true", help="skip the memory measuring pass")
+    parser.add_argument("--output", default=None, help="JSON lines file, defaults to stdout")
+    arguments = parser.parse_args()
+
+    if arguments.conformance:
+        backendnames = ["numpy"] + [name for name in particleCode.availableBackends() if name != "numpy"]
+        mismatches = runConformance(backendnames, arguments.particles[0], arguments.boundary[0], arguments.steps, arguments.seed, arguments.collisionmode, arguments.compact)
+        print(json.dumps({"conformance": mismatches}))
+        sys.exit(1 if any(step is not None for step in mismatches.values()) else 0)
+
+    gravitysteps = arguments.gravitysteps
+    if gravitysteps is None:
+        gravitysteps = arguments.steps // 10
+
+    output = open(arguments.output, "a") if arguments.output else sys.stdout
+    try:
+        for boundary in arguments.boundary:
+            for numberofparticles in arguments.particles:
+                for workers in arguments.workers:
+                    result = runBenchmark(numberofparticles, boundary, workers, arguments.steps, gravitysteps, arguments.engine, arguments.seed, arguments.collisionmode, arguments.backend, arguments.compact, arguments.tilesize, not arguments.nomemory)
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -1,9 +1,12 @@
+import json
 import logging
+import os
+import struct
 import time
 import threading
-from collections import Counter
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from particleMetrics import NullMetrics
 
 class Particle(object):
     def __init__(self):
@@ -26,6 +29,86 @@ class Particle(object):
             self._vx = vx
             self._vy = vy
         
+# Structure-of-arrays particle store
+# Positions and velocities live in two contiguous (n, 2) arrays, column 0 is x and column 1 is y
+# Kernels operate on the arrays directly, indexing returns a ParticleView for older code
+# Velocities may use a narrower type than positions, see compactDtypes
+class ParticleArray(object):
+    def __init__(self, numberofparticles, dtype=np.int64, velocitydtype=None):
+        if velocitydtype is None:
+            velocitydtype = dtype
+        self.positions = np.zeros((numberofparticles, 2), dtype=dtype)
+        self.velocities = np.zeros((numberofparticles, 2), dtype=velocitydtype)
+
+    @classmethod
+    def fromArrays(cls, positions, velocities):
+        # Wraps existing (n, 2) arrays without copying, e.g. arrays living in shared memory
+        particles = cls.__new__(cls)
+        particles.positions = positions
+        particles.velocities = velocities
+        return particles
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        return ParticleView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.positions)):
+            yield ParticleView(self, index)
+
+# Thin compatibility view of a single row in a ParticleArray
+# Behaves like Particle() so code that still iterates particles keeps working
+# Writes go straight into the backing arrays, no per-particle lock
+class ParticleView(object):
+    __slots__ = ("_particles", "_index")
+
+    def __init__(self, particles, index):
+        self._particles = particles
+        self._index = index
+
+    def __iter__(self):
+        yield self._x, self._y
+
+    @property
+    def _x(self):
+        return int(self._particles.positions[self._index, 0])
+
+    @_x.setter
+    def _x(self, x):
+        self._particles.positions[self._index, 0] = x
+
+    @property
+    def _y(self):
+        return int(self._particles.positions[self._index, 1])
+
+    @_y.setter
+    def _y(self, y):
+        self._particles.positions[self._index, 1] = y
+
+    @property
+    def _vx(self):
+        return int(self._particles.velocities[self._index, 0])
+
+    @_vx.setter
+    def _vx(self, vx):
+        self._particles.velocities[self._index, 0] = vx
+
+    @property
+    def _vy(self):
+        return int(self._particles.velocities[self._index, 1])
+
+    @_vy.setter
+    def _vy(self, vy):
+        self._particles.velocities[self._index, 1] = vy
+
+    def setPosition(self, x, y):
+        self._particles.positions[self._index] = (x, y)
+
+    def setVelocities(self, vx, vy):
+        self._particles.velocities[self._index] = (vx, vy)
+
 class AtomicCounter:
     def __init__(self, value=0):
         self._value = value
@@ -41,6 +124,11 @@ class AtomicCounter:
             self._value -= 1
             return self._value
 
+    def add(self, amount):
+        with self._lock:
+            self._value += amount
+            return self._value
+
     @property
     def value(self):
         with self._lock:
@@ -52,27 +140,6 @@ class AtomicCounter:
             self._value = v
             return self._value
 
-def initialPosition(particle, listofpositions, boundary):  
-    position = [particle._x, particle._y]
-
-    updateX = position[0] 
-    updateY = position[1]
-    position = [updateX, updateY] 
-
-    while position in listofpositions:
-        logging.info("Main : Position taken") 
-        if updateX > boundary:
-            updateX = updateX - boundary
-
-        if updateY > boundary:
-            updateY = updateY - boundary                
-        
-        updateX = position[0] + 1
-        updateY = position[1] + 1
-        position = [updateX, updateY]        
-        
-    return position
-
 def updatePosition(index, listofparticles, boundary):  
     # Summary:
     # Updates particle positions using their internal velocities.
@@ -109,6 +176,150 @@ def updatePosition(index, listofparticles, boundary):
     particle.setPosition(updateX, updateY)
     return position
 
+def moveParticles(positions, velocities, boundary):
+    # Summary:
+    # Batched version of updatePosition, advances every particle in a single array pass.
+    # Both axes are handled at once and positions/velocities are updated in place.
+    # Same edge cases as updatePosition:
+    # Overshooting boundary reflects back inside and going below 0 reflects about 0,
+    # landing exactly on 0 or boundary keeps the position but still reverses the velocity.
+    updated = positions + velocities
+    over = updated > boundary
+    under = updated < 0
+    bounced = over | under | (updated == boundary) | (updated == 0)
+
+    updated = np.where(over, boundary - (updated - boundary), updated)
+    updated = np.where(under, -updated, updated)
+    np.negative(velocities, out=velocities, where=bounced)
+    positions[...] = updated
+    return positions
+
+def findCollisionGroups(positions, boundary):
+    # Summary:
+    # Finds every cell occupied by two or more particles in one sort-based pass.
+    # Each position is flattened to a single int64 cell key so any boundary up to ~3e9 fits.
+    # A stable sort keeps the particle indices inside a cell in ascending order.
+    # Returns (order, starts, counts): the particles of collision group g are
+    # order[starts[g]:starts[g] + counts[g]]
+    cells = positions[:, 0].astype(np.int64) * (boundary + 1) + positions[:, 1]
+    return groupRuns(cells)
+
+def groupRuns(keys):
+    # Stable sort of keys, returns (order, starts, counts) for every run of two or more equal keys
+    order = np.argsort(keys, kind="stable")
+    sortedkeys = keys[order]
+    runstarts = np.flatnonzero(np.concatenate(([True], sortedkeys[1:] != sortedkeys[:-1])))
+    runcounts = np.diff(np.append(runstarts, len(sortedkeys)))
+    colliding = runcounts > 1
+    return order, runstarts[colliding], runcounts[colliding]
+
+def expandRanges(starts, stops):
+    # Turns [start, stop) ranges into (range number, value) pairs for every value they cover
+    lengths = np.maximum(stops - starts, 0)
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    values = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return owner, values
+
+def earliestContacts(first, second, times, numberofparticles):
+    # Picks disjoint pairs in order of contact time, each particle keeps only its earliest contact
+    # Every round accepts the pairs that are the earliest remaining contact of both their particles,
+    # which gives the same pairs as going through them one by one. Returns the chosen pair numbers
+    pairs = np.lexsort((second, first, times))
+    chosen = []
+    while len(pairs) > 0:
+        rank = np.arange(len(pairs))
+        earliest = np.full(numberofparticles, len(pairs))
+        np.minimum.at(earliest, first[pairs], rank)
+        np.minimum.at(earliest, second[pairs], rank)
+        mutual = (earliest[first[pairs]] == rank) & (earliest[second[pairs]] == rank)
+        chosen.append(pairs[mutual])
+        paired = np.zeros(numberofparticles, dtype=bool)
+        paired[first[pairs[mutual]]] = True
+        paired[second[pairs[mutual]]] = True
+        pairs = pairs[~(paired[first[pairs]] | paired[second[pairs]])]
+    return np.concatenate(chosen) if chosen else np.zeros(0, dtype=np.int64)
+
+def findSweptCollisionGroups(previous, positions, boundary):
+    # Summary:
+    # Continuous collision detection, catches particles that pass through each other during a step.
+    # Each particle travels in a straight line from previous to positions over t in [0, 1]
+    # (a particle that bounced off a wall is approximated by that straight chord).
+    # Two particles collide if their unit cells overlap at some point of the step.
+    # Particles ending in the same cell form exactly the groups of findCollisionGroups, the rest
+    # collide in pairs: each keeps its earliest contact with another particle left over, so a
+    # particle takes part in one collision per step and velocities only pass between particles
+    # that actually touched. The group count is therefore never below findCollisionGroups'.
+    #
+    # Broad phase: swept boxes are sorted by (min x, min y). Every particle searches the sorted
+    # keys only in the columns its own box covers, so the cost stays close to O(n log n).
+    # Narrow phase: per axis the interval of t where the cells overlap is solved exactly.
+    # Returns (order, starts, counts) like findCollisionGroups.
+    numberofparticles = len(positions)
+    cellorder, cellstarts, cellcounts = findCollisionGroups(positions, boundary)
+    start = previous.astype(np.int64)
+    end = positions.astype(np.int64)
+    low = np.minimum(start, end)
+    high = np.maximum(start, end)
+    if numberofparticles < 2:
+        return cellorder, cellstarts, cellcounts
+
+    width = boundary + 1
+    keys = low[:, 0] * width + low[:, 1]
+    order = np.argsort(keys, kind="stable")
+    sortedkeys = keys[order]
+    rank = np.empty(numberofparticles, dtype=np.int64)
+    rank[order] = np.arange(numberofparticles)
+    xreach = high[:, 0] - low[:, 0]
+    yextent = int((high[:, 1] - low[:, 1]).max())
+
+    firsts = []
+    seconds = []
+    for dx in range(int(xreach.max()) + 1):
+        candidates = np.flatnonzero(xreach >= dx)
+        column = (low[candidates, 0] + dx) * width
+        lower = np.searchsorted(sortedkeys, column + np.maximum(low[candidates, 1] - yextent, 0), side="left")
+        upper = np.searchsorted(sortedkeys, column + high[candidates, 1], side="right")
+        if dx == 0:
+            # Same starting column, only look ahead so each pair is found once
+            lower = np.maximum(lower, rank[candidates] + 1)
+        owner, index = expandRanges(lower, upper)
+        firsts.append(candidates[owner])
+        seconds.append(order[index])
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+
+    # Boxes must overlap on y as well
+    overlap = (low[second, 1] <= high[first, 1]) & (low[first, 1] <= high[second, 1])
+    # Lower index first, so ties in contact time are broken the same way whichever particle found the pair
+    first, second = np.minimum(first[overlap], second[overlap]), np.maximum(first[overlap], second[overlap])
+
+    # Relative position is a + b * t, the cells overlap while |a + b * t| < 1 on both axes
+    a = start[first] - start[second]
+    b = (end[first] - end[second]) - a
+    enter = np.zeros(len(first))
+    leave = np.ones(len(first))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for axis in (0, 1):
+            offset = a[:, axis].astype(np.float64)
+            rate = b[:, axis].astype(np.float64)
+            moving = rate != 0
+            t1 = (-1 - offset) / rate
+            t2 = (1 - offset) / rate
+            # Not moving relative to each other: overlapping all step or never
+            always = np.abs(offset) < 1
+            enter = np.maximum(enter, np.where(moving, np.minimum(t1, t2), np.where(always, -np.inf, np.inf)))
+            leave = np.minimum(leave, np.where(moving, np.maximum(t1, t2), np.where(always, np.inf, -np.inf)))
+    # Particles already in a shared end cell are left out of the pairs
+    grouped = np.zeros(numberofparticles, dtype=bool)
+    grouped[cellorder[expandRanges(cellstarts, cellstarts + cellcounts)[1]]] = True
+    hit = (enter < leave) & ~grouped[first] & ~grouped[second]
+    chosen = earliestContacts(first[hit], second[hit], enter[hit], numberofparticles)
+    pairs = np.stack((first[hit][chosen], second[hit][chosen]), axis=1).ravel()
+    order = np.concatenate((cellorder, pairs))
+    starts = np.concatenate((cellstarts, len(cellorder) + 2 * np.arange(len(chosen))))
+    counts = np.concatenate((cellcounts, np.full(len(chosen), 2, dtype=cellcounts.dtype)))
+    return order, starts, counts
+
 # Stops X-axis movement. All particles fall down y-Axis 1 point per loop
 # To make particles fall through change fall-through to true (Manually)
 def haltforgravity(index, listofparticles, boundary):
@@ -127,8 +338,16 @@ def haltforgravity(index, listofparticles, boundary):
 
     particle.setPosition(updateX, updateY)
 
-# Each collision is its own thread
-# May be slow if multiple particles collide in the same space
+def haltParticles(positions, boundary):
+    # Batched version of haltforgravity, every particle falls one point down the x-axis
+    # Particles already at 0 fall through and reappear at boundary
+    x = positions[:, 0]
+    np.putmask(x, x == 0, boundary + 1)
+    x -= 1
+    return positions
+
+# Scalar reference for a single collision group, only resolves groups of two
+# The simulation itself uses the batched resolveCollisions below
 numofcollisons = 0
 def checkPossibleCollisions(particlesindices, listofparticles):
     velocities = []
@@ -177,207 +396,587 @@ def checkPossibleCollisions(particlesindices, listofparticles):
         listofparticles[index].setVelocities(velocity[0], velocity[1])
     #print(positions)
     #time.sleep(5)
-      
-lock = threading.Lock()
-def thread_main(threadId, listofparticles, boundary):
-    global lock  
-    #logging.info("Movement Thread %d : Begin",id)
-    with lock:
-        updatePosition(threadId, listofparticles, boundary)
-    #logging.info("Movement Thread %d : End",id)
-
-def thread_collision(particlesindices, listofparticles):
-    global lock  
-    #logging.info("Collision Thread %d : Begin",id)
-    with lock:
-        checkPossibleCollisions(particlesindices, listofparticles)
-    #logging.info("Collision Thread %d : End",id)
-
-# Each particle has it's own thread when gravity in effect
-# Should take over from thread_main and return control afterwards
-# Internal vectors remain unaffected
-def thread_gravstop(threadId, listofparticles, boundary):
-    global lock  
-    #logging.info("Gravity Thread %d : Begin",id)
-    with lock:
-        haltforgravity(threadId, listofparticles, boundary)
-    #logging.info("Gravity Thread %d : End",id)
+
+def resolveCollisions(velocities, order, starts, counts):
+    # Summary:
+    # Resolves every collision group of a frame at once, groups come from findCollisionGroups.
+    # Each axis is handled independently using segmented reductions over the groups.
+    # Two particles keep the checkPossibleCollisions rules:
+    #   Opposite velocities (a == -b) are both reversed
+    #   If one of them is stationary on the axis the velocities are swapped
+    #   Otherwise the axis is left unchanged
+    # Three or more particles:
+    #   If the group's momentum on the axis sums to zero every velocity is reversed
+    #   Otherwise momentum is passed along the group, each particle takes the next one's velocity
+    # Both rules conserve momentum and keep velocities inside the initial speed range.
+    if len(starts) == 0:
+        return velocities
+
+    # Flatten the segments into one contiguous list of members
+    total = int(counts.sum())
+    groupstarts = np.cumsum(counts) - counts
+    groupid = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(total) - groupstarts[groupid]
+    members = order[starts[groupid] + offsets]
+    grouped = velocities[members]
+
+    # Per-group momentum and the cyclic neighbour of every member
+    momentum = np.add.reduceat(grouped, groupstarts, axis=0, dtype=np.int64)[groupid]
+    groupsize = counts[groupid][:, None]
+    nextmember = np.where(offsets + 1 == counts[groupid], groupstarts[groupid], np.arange(total) + 1)
+    rotated = grouped[nextmember]
+
+    # For a pair rotating is a swap, which only applies when one side is stationary
+    swap = (groupsize > 2) | (grouped == 0) | (rotated == 0)
+    resolved = np.where(swap, rotated, grouped)
+    resolved = np.where(momentum == 0, -grouped, resolved)
+    velocities[members] = resolved
+    return velocities
+
+# Force field applied during gravity phases
+# gravity   - (x, y) cells every particle moves per frame, the default falls one cell down x
+#             like haltforgravity
+# attractor - (x, y) point particles are pulled towards, None for no attractor
+# strength  - most cells the attractor pulls per axis per frame, it never pulls past the point
+# floor     - what happens at the walls: "wrap" comes back in at the opposite wall, the old
+#             fallthrough = True, "stop" leaves particles resting against the wall
+# Gravity and attractor add up and the result is applied in one pass over the arrays.
+floors = ("wrap", "stop")
+
+class ForceField(object):
+    def __init__(self, gravity=(-1, 0), attractor=None, strength=1, floor="wrap"):
+        if floor not in floors:
+            raise ValueError("unknown floor %r, expected one of %s" % (floor, ", ".join(floors)))
+        self.gravity = np.array(gravity, dtype=np.int64)
+        self.attractor = None if attractor is None else np.array(attractor, dtype=np.int64)
+        self.strength = int(strength)
+        self.floor = floor
+
+    @property
+    def plain(self):
+        # True for the original gravity, which the backends' haltParticles kernel implements
+        return self.attractor is None and self.floor == "wrap" and self.gravity.tolist() == [-1, 0]
+
+    def apply(self, positions, boundary):
+        moved = positions.astype(np.int64)
+        moved += self.gravity
+        if self.attractor is not None:
+            moved += np.clip(self.attractor - positions, -self.strength, self.strength)
+        if self.floor == "wrap":
+            np.mod(moved, boundary + 1, out=moved)
+        else:
+            np.clip(moved, 0, boundary, out=moved)
+        positions[...] = moved
+        return positions
+
+forcefield = ForceField()
+
+def setForceField(newforcefield):
+    # Engines read this when a gravity phase runs, ProcessEngine when it attaches
+    global forcefield
+    forcefield = newforcefield
+    if engine is not None and engine.forcefield is not None:
+        engine.forcefield = forcefield
+
+# Compute backends
+# A backend supplies the array kernels the engines call:
+#   moveParticles(positions, velocities, boundary)
+#   haltParticles(positions, boundary)
+#   findCollisionGroups(positions, boundary)
+#   findSweptCollisionGroups(previous, positions, boundary)
+#   resolveCollisions(velocities, order, starts, counts)
+# Every backend must produce exactly the same trajectories as the NumPy reference,
+# particleBenchmark.py --conformance checks that.
+class NumpyBackend(object):
+    name = "numpy"
+    moveParticles = staticmethod(moveParticles)
+    haltParticles = staticmethod(haltParticles)
+    findCollisionGroups = staticmethod(findCollisionGroups)
+    findSweptCollisionGroups = staticmethod(findSweptCollisionGroups)
+    resolveCollisions = staticmethod(resolveCollisions)
+
+def loadNumbaBackend():
+    # Optional, needs numba installed
+    from particleNumba import NumbaBackend
+    return NumbaBackend()
+
+# Name -> factory, registerBackend adds more
+backends = {"numpy": NumpyBackend, "numba": loadNumbaBackend}
+def registerBackend(name, factory):
+    backends[name] = factory
+
+def createBackend(name):
+    if name not in backends:
+        raise ValueError("unknown backend %r, choose from %s" % (name, ", ".join(sorted(backends))))
+    return backends[name]()
+
+def availableBackends():
+    # Backends whose dependencies can be imported here
+    available = []
+    for name in sorted(backends):
+        try:
+            createBackend(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+# Backend the default engine is created with
+backendname = "numpy"
+
+# Number of worker threads in the default engine
+numberofworkers = os.cpu_count() or 1
+
+# Execution backend with a long-lived pool of worker threads
+# The particle arrays are split into one contiguous slice per worker
+# Slices never overlap so workers write without any lock
+# NumPy releases the GIL inside its kernels so slices run in parallel
+class ThreadEngine(object):
+    # Arrays shorter than this per worker are not worth handing to another thread
+    minimumslice = 16384
+
+    def __init__(self, numberofworkers=None, metrics=None, collisionmode=None, backend=None, forcefield=None):
+        if numberofworkers is None:
+            numberofworkers = globals()["numberofworkers"]
+        self.numberofworkers = max(1, int(numberofworkers))
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.collisionmode = collisionmode if collisionmode is not None else globals()["collisionmode"]
+        self.backend = createBackend(backend if backend is not None else backendname)
+        self.forcefield = forcefield
+        self.previous = None
+        self.index = None
+        self._pool = ThreadPoolExecutor(max_workers=self.numberofworkers, thread_name_prefix="particle")
+
+    def slices(self, length):
+        # Contiguous [start, stop) ranges covering 0..length, at most one per worker
+        count = min(self.numberofworkers, max(1, length // self.minimumslice))
+        bounds = np.linspace(0, length, count + 1).astype(np.int64).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def run(self, kernel, length):
+        # Runs kernel(start, stop) over every slice and waits for all of them
+        slices = self.slices(length)
+        if len(slices) == 1:
+            return [kernel(0, length)]
+        futures = [self._pool.submit(kernel, start, stop) for start, stop in slices]
+        return [future.result() for future in futures]
+
+    def move(self, particles, boundary):
+        positions = particles.positions
+        velocities = particles.velocities
+        metrics = self.metrics
+        backend = self.backend
+
+        def kernel(start, stop):
+            backend.moveParticles(positions[start:stop], velocities[start:stop], boundary)
+            metrics.count("moved", stop - start)
+
+        with metrics.phase("movement"):
+            # Swept detection needs where every particle started the step
+            if self.collisionmode == "sweep":
+                self.previous = positions.copy()
+            self.run(kernel, len(positions))
+
+    def detect(self, particles, boundary):
+        # One global sort, groups may span any part of the arrays
+        with self.metrics.phase("detection"):
+            if self.collisionmode == "sweep":
+                return self.backend.findSweptCollisionGroups(self.previous, particles.positions, boundary)
+            if self.collisionmode == "index":
+                # Nearly every particle changes cell each step, so the index is rebuilt rather than
+                # updated, the gain over findCollisionGroups is the linear radix sort
+                if self.index is None or self.index.boundary != boundary:
+                    from particleIndex import CellIndex
+                    self.index = CellIndex(boundary)
+                return self.index.rebuild(particles.positions).collisionGroups()
+            return self.backend.findCollisionGroups(particles.positions, boundary)
+
+    def resolve(self, particles, groups):
+        # Collision groups are disjoint so each worker takes a contiguous run of groups
+        order, starts, counts = groups
+        velocities = particles.velocities
+        metrics = self.metrics
+        backend = self.backend
+
+        def kernel(start, stop):
+            backend.resolveCollisions(velocities, order, starts[start:stop], counts[start:stop])
+            metrics.count("collisions", stop - start)
+
+        with metrics.phase("resolution"):
+            self.run(kernel, len(starts))
+        return len(starts)
+
+    def gravity(self, particles, boundary):
+        positions = particles.positions
+        metrics = self.metrics
+        field = self.forcefield if self.forcefield is not None else forcefield
+        halt = self.backend.haltParticles if field.plain else field.apply
+
+        def kernel(start, stop):
+            halt(positions[start:stop], boundary)
+            metrics.count("fallen", stop - start)
+
+        with metrics.phase("gravity"):
+            self.run(kernel, len(positions))
+
+    def mainmovementandcollisions(self, atomic, listofparticles):
+        self.move(listofparticles, boundary)
+        groups = self.detect(listofparticles, boundary)
+        atomic.add(self.resolve(listofparticles, groups))
+        self.metrics.frame()
+        return listofparticles
+
+    def gravstopmethod(self, listofparticles):
+        self.gravity(listofparticles, boundary)
+        self.metrics.frame()
+        return listofparticles
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+# Number of worker processes, 0 keeps everything in this process on the ThreadEngine
+# Above 0 the ProcessEngine in particleProcesses.py splits the domain into one strip per process
+numberofprocesses = 0
+
+# How collisions are detected
+# "cell"  - particles collide when they land on the same cell after a step
+# "sweep" - particles also collide when their paths cross during the step, see findSweptCollisionGroups
+# "index" - same collisions as "cell", found from a CellIndex rebuilt every step
+#           (ThreadEngine only, other engines treat it as "cell"), see particleIndex.py
+collisionmode = "cell"
+
+# Instrumentation given to the engine, see particleMetrics.py
+# Disabled by default, setMetrics(Metrics(...)) turns on counters and phase timers
+metrics = NullMetrics()
+
+# Engine used by mainmovementandcollisions and gravstopmethod
+# Created on first use so numberofworkers/numberofprocesses can be changed beforehand
+engine = None
+def getEngine():
+    global engine
+    if engine is None:
+        if numberofprocesses > 0:
+            from particleProcesses import ProcessEngine
+            # Passed explicitly, run as a script particleProcesses would see a second copy of this module
+            engine = ProcessEngine(numberofprocesses, boundary, metrics, collisionmode, backendname, forcefield)
+        else:
+            engine = ThreadEngine(numberofworkers, metrics, collisionmode, backendname)
+    return engine
+
+def setEngine(newengine):
+    global engine
+    engine = newengine
+    return engine
+
+def closeEngine():
+    # Stops the default engine's workers and releases its shared memory, if one was created
+    # The particles it stepped stay usable, the next getEngine() builds a new engine
+    global engine
+    if engine is not None:
+        engine.close()
+        engine = None
+
+def setMetrics(newmetrics):
+    global metrics
+    metrics = newmetrics if newmetrics is not None else NullMetrics()
+    if engine is not None:
+        engine.metrics = metrics
+    return metrics
 
 # [x,y,z] lengths - Positives only
 boundary = 511
 numberofparticles = 1000
-def initialiseArray():
-    # Initialising particles
-    # Each partical is placed in a unique space [x,y,z]
 
-    # Particle movement speed limit
-    # When a particle is initialised each vector is given a random velocity between -speedLimit and speedLimit
-    # This allows for random movement with particles having different velocities on different vectors
-    speedLimit = 3
+# Particle movement speed limit
+# When a particle is initialised each vector is given a random velocity between -speedLimit and speedLimit
+# This allows for random movement with particles having different velocities on different vectors
+speedLimit = 3
 
-    listofparticles = []
-    listofpositions = []
+# Compact storage picks the narrowest integer types that are safe for boundary and speedLimit
+# e.g. boundary 511 and speedLimit 3 store positions as int16 and velocities as int8
+compactstorage = False
+
+def smallestSignedType(low, high):
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        limits = np.iinfo(dtype)
+        if limits.min <= low and high <= limits.max:
+            return np.dtype(dtype)
+    raise ValueError("no integer type holds [%d, %d]" % (low, high))
+
+def compactDtypes(boundary, speedLimit):
+    # Returns (position dtype, velocity dtype)
+    # Velocities stay within [-speedLimit, speedLimit]: collisions only swap, rotate or negate them
+    # Before a wall bounce a position can be up to speedLimit past either wall, and gravity
+    # briefly stores boundary + 1, so positions need [-speedLimit, boundary + max(speedLimit, 1)]
+    # All kernels compute in the position type or wider, so nothing overflows
+    positiondtype = smallestSignedType(-speedLimit, boundary + max(speedLimit, 1))
+    velocitydtype = smallestSignedType(-speedLimit, speedLimit)
+    return positiondtype, velocitydtype
+
+# Generator used by the last initialiseArray call
+rng = None
+def initialiseArray(seed=None):
+    # Initialising particles
+    # Each particle is placed in a unique space [x,y], the same seed always gives the same particles
+    # Cells are drawn without replacement in bulk so every cell of the grid can be filled
     global numberofparticles
     global boundary
-    for particleId in range(numberofparticles):
-        arrayBoundary = boundary - 1        
-        randomX = np.random.randint(0, arrayBoundary)
-        randomY = np.random.randint(0, arrayBoundary)
-        position = [randomX, randomY]
-        
-        randomVX = np.random.randint(-speedLimit, speedLimit)
-        randomVY = np.random.randint(-speedLimit, speedLimit)
-        while randomVX == 0 and randomVY == 0:
-            randomVX = np.random.randint(-speedLimit, speedLimit)
-            randomVY = np.random.randint(-speedLimit, speedLimit)
-
-        velocities = [randomVX, randomVY]
-        particle = Particle()
-        particle.setPosition(position[0], position[1])
-        particle.setVelocities(velocities[0], velocities[1])
-
-        if [particle._x, particle._y] in listofpositions: 
-            logging.info("Main : Finding new")       
-            newPos = initialPosition(particle, listofpositions, boundary)
-            logging.info("Main : New obtained")      
-            listofpositions.append(newPos)
-            logging.info("Main : Position set")      
-            particle.setPosition(newPos[0], newPos[1])
-            logging.info("Main : Particle set")      
-            listofparticles.append(particle)
-            logging.info("Main : Particle Added") 
-        else: 
-            logging.info("Main : Position set")   
-            #print(position)
-            listofpositions.append([particle._x, particle._y])
-            listofparticles.append(particle)     
+    global rng
+    rng = np.random.default_rng(seed)
+
+    # Positions are drawn from [0, boundary - 1) on each axis
+    arrayBoundary = boundary - 1
+    cellcount = arrayBoundary * arrayBoundary
+    if numberofparticles > cellcount:
+        raise ValueError("%d particles do not fit in %d unique cells" % (numberofparticles, cellcount))
+
+    if compactstorage:
+        listofparticles = ParticleArray(numberofparticles, *compactDtypes(boundary, speedLimit))
+    else:
+        listofparticles = ParticleArray(numberofparticles)
+    cells = rng.choice(cellcount, size=numberofparticles, replace=False)
+    listofparticles.positions[:, 0], listofparticles.positions[:, 1] = np.divmod(cells, arrayBoundary)
+
+    # Velocities in [-speedLimit, speedLimit), redrawing any particle that would be stationary on both axes
+    velocities = listofparticles.velocities
+    velocities[...] = rng.integers(-speedLimit, speedLimit, size=velocities.shape)
+    stationary = np.flatnonzero(~velocities.any(axis=1))
+    while len(stationary) > 0:
+        velocities[stationary] = rng.integers(-speedLimit, speedLimit, size=(len(stationary), 2))
+        stationary = stationary[~velocities[stationary].any(axis=1)]
     return listofparticles
 
+# Checkpoint layout: 8 byte header length, JSON header, positions bytes, velocities bytes
+# The header holds the scalars and the generator state so a restore continues bit-for-bit
+checkpointmagic = "particle-checkpoint-1"
+def saveCheckpoint(path, listofparticles, gravtimer=0, collisions=0):
+    header = {
+        "magic": checkpointmagic,
+        "boundary": boundary,
+        "speedLimit": speedLimit,
+        "numberofparticles": len(listofparticles),
+        "dtype": listofparticles.positions.dtype.str,
+        "velocitydtype": listofparticles.velocities.dtype.str,
+        "gravtimer": gravtimer,
+        "collisions": collisions,
+        "counter": counter,
+        "rng": rng.bit_generator.state if rng is not None else None,
+    }
+    headerbytes = json.dumps(header).encode("utf-8")
+    positions = np.ascontiguousarray(listofparticles.positions)
+    velocities = np.ascontiguousarray(listofparticles.velocities)
+
+    # Everything goes out in a single write, then replaces the old checkpoint in one step
+    data = b"".join((struct.pack("<Q", len(headerbytes)), headerbytes, positions.tobytes(), velocities.tobytes()))
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as checkpoint:
+        checkpoint.write(data)
+    os.replace(temporary, path)
+
+def loadCheckpoint(path):
+    # Restores boundary, speedLimit, numberofparticles and rng
+    # Returns (listofparticles, gravtimer, collisions)
+    global boundary
+    global speedLimit
+    global numberofparticles
+    global counter
+    global rng
+    with open(path, "rb") as checkpoint:
+        data = checkpoint.read()
+
+    headerlength = struct.unpack_from("<Q", data)[0]
+    header = json.loads(data[8:8 + headerlength].decode("utf-8"))
+    if header.get("magic") != checkpointmagic:
+        raise ValueError("%s is not a particle checkpoint" % path)
+
+    dtype = np.dtype(header["dtype"])
+    velocitydtype = np.dtype(header.get("velocitydtype", header["dtype"]))
+    count = header["numberofparticles"]
+    arraybytes = count * 2 * dtype.itemsize
+    start = 8 + headerlength
+    listofparticles = ParticleArray.fromArrays(
+        np.frombuffer(data, dtype=dtype, count=count * 2, offset=start).reshape(count, 2).copy(),
+        np.frombuffer(data, dtype=velocitydtype, count=count * 2, offset=start + arraybytes).reshape(count, 2).copy())
+
+    boundary = header["boundary"]
+    speedLimit = header["speedLimit"]
+    numberofparticles = count
+    counter = header["counter"]
+    rng = None
+    if header["rng"] is not None:
+        bitgenerator = getattr(np.random, header["rng"]["bit_generator"])()
+        bitgenerator.state = header["rng"]
+        rng = np.random.Generator(bitgenerator)
+    return listofparticles, header["gravtimer"], header["collisions"]
+
 counter = 0
 def mainmovementandcollisions(atomic, listofparticles):
-    global numberofparticles
-    global boundary
     global counter
-    numberofparticlethreads = numberofparticles
-    
-    logging.info("Main : Position/Collision loop: %d", counter)
+    logging.debug("Main : Position/Collision loop: %d", counter)
     counter += 1
-    # Obtains the current state of each object placing into a list of objects
-    particlepositions = []
-    for particle in listofparticles:
-        particlepositions.append([particle._x, particle._y])
-
-    # Places each object into a thread where it's vectors are updated based on the object velocity
-    listofparticlethreads=[] 
-    velocitylist = []
-    for id in range(numberofparticlethreads):
-        velocities = [listofparticles[id]._vx, listofparticles[id]._vy]
-        velocitylist.append(velocities)
-        particlethread = threading.Thread(target=thread_main,args=(id, listofparticles, boundary))
-        listofparticlethreads.append(particlethread)
-        particlethread.start()
-
-    # Joins the position update threads
-    for particlethread in listofparticlethreads:
-        particlethread.join()
-
-    # Debugging positions & velocities - Manually change boolean
-    debugBool = False
-    if debugBool:
-        print(particlepositions)
-        #print(velocitylist)
-        sleeptimer = 2
-        logging.info("Main : Sleeping for %d seconds",sleeptimer)
-        time.sleep(sleeptimer)
-
-    # Colliding particles only register if they occupy the same space
-    # A list of indices that are occupied by two or more particles is returned
-    # This is done to reduce the search space and increase algorithm performance
-    tupleDups = Counter(map(tuple,listofparticles))
-    dups = [k for k,v in tupleDups.items() if v > 1] 
-    dupList = []
-    if len(dups) > 0:
-        for dup in dups:
-            # Currently tuple within tuple, retrieves the actual coordiantes tuple
-            position = dup[0]
-            # Converts coordinates tuple to a list
-            positionaslist = [position[0], position[1]]
-            dupList.append(positionaslist)
-
-    # Turns unhashable lists into hashable tuples
-    particlepositions = []
-    for particle in listofparticles:
-        particlepositions.append(tuple([particle._x, particle._y]))
-
-    # Enumerate the tuples storing them and the particle indices in a dict
-    d = defaultdict(list)
-    for keyindex, value in enumerate(particlepositions):
-        d[value].append(keyindex)
-        
-    collisionthreads = []
-    # Retrieve duplicate indices (Particles that collide this iteration)
-    for dup in dupList:
-        dup = tuple(dup)
-        collisionthread = threading.Thread(target=(checkPossibleCollisions), args=(d[dup], listofparticles))
-        collisionthread.start()
-        collisionthreads.append(collisionthread)
-        atomic.inc()
-        #print(d[dup])
-        
-    for collisionthread in collisionthreads:
-        collisionthread.join()
-        
-    particlepositions = []
-    for particle in listofparticles:
-        particlepositions.append(tuple([particle._x, particle._y]))
-
-    # Debugging positions & velocities - Manually change boolean
-    debugBool = False
-    if debugBool:
-        print(particlepositions)
-        #print(velocitylist)
-        sleeptimer = 2
-        #logging.info("Main : Sleeping for %d seconds",sleeptimer)
-        #time.sleep(sleeptimer)
 
-    return listofparticles
+    # Movement, collision detection and collision resolution run on the engine's worker pool
+    # Per-phase timings and counters go to the engine's metrics, see setMetrics
+    return getEngine().mainmovementandcollisions(atomic, listofparticles)
 
 def gravstopmethod(listofparticles):
-    global numberofparticles
-    gravstopthreads = []
-    for id in range(numberofparticles):
-        gravitythread = threading.Thread(target=(thread_gravstop), args=(id, listofparticles, boundary))
-        gravstopthreads.append(gravitythread)
-        gravitythread.start()
-
-    for gravitythread in gravstopthreads:
-        gravitythread.join()
-
-    particlepositions = []
-    for particle in listofparticles:
-        particlepositions.append([particle._x, particle._y])
-    
-    #print(particlepositions)
-    #time.sleep(1)
-    return listofparticles
+    # Gravity runs on the engine's worker pool, internal vectors remain unaffected
+    return getEngine().gravstopmethod(listofparticles)
+
+# Declarative phase schedule
+# Each phase runs one step method over a frame range [start, stop), frames outside every phase
+# run "movement". With period set the range repeats every period frames.
+# The step methods are looked up in phasemethods, new phases are added by registering there.
+phasemethods = {
+    "movement": lambda engine, atomic, listofparticles: engine.mainmovementandcollisions(atomic, listofparticles),
+    "gravity": lambda engine, atomic, listofparticles: engine.gravstopmethod(listofparticles),
+}
+
+class Schedule(object):
+    def __init__(self, phases=()):
+        self.phases = []
+        for phase in phases:
+            self.add(*phase)
+
+    def add(self, name, start, stop, period=None):
+        if name not in phasemethods:
+            raise ValueError("unknown phase %r, expected one of %s" % (name, ", ".join(sorted(phasemethods))))
+        if stop <= start or (period is not None and period < stop - start):
+            raise ValueError("phase %r has an empty or overlapping frame range" % name)
+        self.phases.append((name, start, stop, period))
+        return self
+
+    def phaseAt(self, frame):
+        # (name, next frame where any phase starts or ends) for the given frame
+        # end is None when nothing changes after frame, later phases win where ranges overlap
+        name, end = "movement", None
+        for phasename, start, stop, period in self.phases:
+            if frame < start:
+                change = start
+            else:
+                if period is not None:
+                    shift = (frame - start) // period * period
+                    start, stop = start + shift, stop + shift
+                if frame < stop:
+                    name, change = phasename, stop
+                else:
+                    change = start + period if period is not None else None
+            if change is not None and (end is None or change < end):
+                end = change
+        return name, end
+
+# Reproduces the original gravtimer window: 12 frames of movement, then 14 of gravity
+defaultschedule = Schedule([("gravity", 12, 26)])
+
+class Simulation(object):
+    # Advances a particle store through a schedule, many frames per call
+    # frame counts every step taken, it is what the checkpoint stores as gravtimer
+    def __init__(self, listofparticles, schedule=None, atomic=None, frame=0):
+        self.listofparticles = listofparticles
+        self.schedule = schedule if schedule is not None else defaultschedule
+        self.atomic = atomic if atomic is not None else AtomicCounter()
+        self.frame = frame
+        self.phase = None
+        self.callbacks = []
+        self.stopping = False
+
+    def stop(self):
+        # Makes step() return at the next frame boundary, safe to call from a signal handler
+        self.stopping = True
+
+    def addCallback(self, callback, every=1):
+        # callback(simulation) runs after every frame that is a multiple of every
+        self.callbacks.append((callback, max(1, int(every))))
+
+    def step(self, n=1):
+        # Runs n frames, the engine is called directly in runs of frames sharing a phase
+        # so the only per-frame Python work is the loop itself
+        global counter
+        stepengine = getEngine()
+        target = self.frame + n
+        while self.frame < target:
+            name, end = self.schedule.phaseAt(self.frame)
+            if name != self.phase:
+                logging.info("Main : %s phase from frame %d", name.capitalize(), self.frame)
+                self.phase = name
+            stop = target if end is None else min(end, target)
+            for callback, every in self.callbacks:
+                stop = min(stop, (self.frame // every + 1) * every)
+
+            method = phasemethods[name]
+            first = self.frame
+            while self.frame < stop and not self.stopping:
+                self.listofparticles = method(stepengine, self.atomic, self.listofparticles)
+                self.frame += 1
+            if name == "movement":
+                # Keeps the module counter, which checkpoints store, in step with mainmovementandcollisions
+                counter += self.frame - first
+            if self.stopping:
+                return self.listofparticles
+            for callback, every in self.callbacks:
+                if self.frame % every == 0:
+                    callback(self)
+        return self.listofparticles
+
+    @property
+    def gravityhalt(self):
+        return self.phase == "gravity"
 
 if __name__ == "__main__":
+    import argparse
+    from particleMetrics import Metrics
+    parser = argparse.ArgumentParser(description="Particle simulation without a display")
+    parser.add_argument("--metrics", default=None, help="append per-frame counters and phase timings to this JSON lines file")
+    parser.add_argument("--metricsevery", type=int, default=1, help="only record every nth frame")
+    parser.add_argument("--record", default=None, help="write every step's positions and velocities to this trajectory file")
+    parser.add_argument("--recordbuffer", type=float, default=16, metavar="MB", help="size of one recorder chunk, three are kept in memory")
+    parser.add_argument("--analytics", default=None, help="stream density, energy, collision rate and radial samples here (.csv or binary log)")
+    parser.add_argument("--analyticsevery", type=int, default=10, help="take an analytics sample every nth frame")
+    parser.add_argument("--serve", default=None, metavar="HOST:PORT", help="stream frames to TCP and WebSocket viewers")
+    parser.add_argument("--serveevery", type=int, default=1, help="only stream every nth frame")
+    parser.add_argument("--render", default=None, metavar="DIRECTORY", help="write frames as images without a display")
+    parser.add_argument("--renderformat", choices=["png", "ppm", "raw"], default="png")
+    parser.add_argument("--renderevery", type=int, default=1, help="only render every nth frame")
+    parser.add_argument("--colourmode", choices=["default", "solid", "speed", "centermass"], default="default", help="same colour modes as the opengl.py keys")
+    parser.add_argument("--gravity", default="-1,0", metavar="X,Y", help="cells every particle moves per gravity frame")
+    parser.add_argument("--attractor", default=None, metavar="X,Y", help="point particles are pulled towards during gravity frames")
+    parser.add_argument("--strength", type=int, default=1, help="most cells the attractor pulls per axis per frame")
+    parser.add_argument("--floor", choices=floors, default="wrap", help="wrap to the opposite wall or stop at the wall")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the initial particles")
+    parser.add_argument("--resume", default=None, help="continue from this checkpoint instead of initialising")
+    parser.add_argument("--checkpoint", default=None, help="save a checkpoint here when the run ends or is interrupted")
+    parser.add_argument("--seconds", type=float, default=60 * 2, help="how long to run for")
+    parser.add_argument("--batch", type=int, default=100, help="frames stepped between checks of the clock")
+    parser.add_argument("--backend", choices=sorted(backends), default=backendname, help="kernel implementation")
+    parser.add_argument("--compact", action="store_true", help="store positions and velocities in the narrowest safe integer types")
+    arguments = parser.parse_args()
+
     logging.basicConfig(format="%(asctime)s: %(message)s",level=logging.INFO,datefmt="%H:%M:%S")    
     logging.info("Main : Begin")
+    backendname = arguments.backend
+    compactstorage = arguments.compact
+    attractor = [int(value) for value in arguments.attractor.split(",")] if arguments.attractor else None
+    setForceField(ForceField([int(value) for value in arguments.gravity.split(",")], attractor, arguments.strength, arguments.floor))
+    if arguments.metrics:
+        setMetrics(Metrics(arguments.metricsevery, path=arguments.metrics))
     
-    # Initialise array
-    logging.info("Main : Particles initialising...")
-    listofparticles = initialiseArray()
-    logging.info("Main : Particles initialised.")
+    gravtimer = 0
+    atomic = AtomicCounter()
+    if arguments.resume:
+        logging.info("Main : Restoring checkpoint %s", arguments.resume)
+        listofparticles, gravtimer, collisions = loadCheckpoint(arguments.resume)
+        atomic.value = collisions
+    else:
+        # Initialise array
+        logging.info("Main : Particles initialising...")
+        listofparticles = initialiseArray(arguments.seed)
+        logging.info("Main : Particles initialised.")
     
     # Log to show no duplicates exist initially
     # Not necessary in openGL
     logging.info("Main : Checking for duplicate initial positions")
-    particlepositions = []
-    for particle in listofparticles:
-        particlepositions.append([particle._x, particle._y])
-    c = Counter(map(tuple,particlepositions))
-    dups = [k for k,v in c.items() if v>1]  
+    order, starts, counts = findCollisionGroups(listofparticles.positions, boundary)
+    dups = listofparticles.positions[order[starts]].tolist()
     dupCount = len(dups)    
     if dupCount > 0:
         print("Number of duplicates found:", dupCount)
@@ -389,46 +988,53 @@ if __name__ == "__main__":
     else:        
         logging.info("Main : No duplicate positions : Simulation starting...")
 
-    gravstop = True
-    atomic = AtomicCounter()
-    timeout = time.time() + (60 * 2) 
-    gravtimer = 0
-    while True:
-        listofparticles = mainmovementandcollisions(atomic, listofparticles)  
-        
-        enteredGrav = False
-        while gravtimer > 10 and gravtimer < 25:
-            if enteredGrav == False:
-                logging.info("Main : Gravity in effect")
-
-            enteredGrav = True
-            listofparticles = gravstopmethod(listofparticles)
-
-            #gravstopthreads = []
-            #for id in range(numberofparticles):
-            #        gravitythread = threading.Thread(target=(thread_gravstop), args=(id, listofparticles, boundary))
-            #        gravstopthreads.append(gravitythread)
-            #        gravitythread.start()
-
-            #for gravitythread in gravstopthreads:
-            #    gravitythread.join()
-
-            #particlepositions = []
-            #for particle in listofparticles:
-            #    particlepositions.append([particle._x, particle._y])
+    timeout = time.time() + arguments.seconds
+    simulation = Simulation(listofparticles, atomic=atomic, frame=gravtimer)
+    recorder = None
+    if arguments.record:
+        from particleRecorder import TrajectoryRecorder
+        recorder = TrajectoryRecorder(arguments.record, len(listofparticles), boundary, listofparticles.positions.dtype, chunkbytes=int(arguments.recordbuffer * (1 << 20)))
+        simulation.addCallback(lambda simulation: recorder.record(simulation.listofparticles))
+    analytics = None
+    if arguments.analytics:
+        from particleAnalytics import Analytics
+        analytics = Analytics(boundary, path=arguments.analytics)
+        simulation.addCallback(analytics.callback, arguments.analyticsevery)
+    renderer = None
+    if arguments.render:
+        from particleRender import OffscreenRenderer
+        renderer = OffscreenRenderer(arguments.render, len(listofparticles), imageformat=arguments.renderformat, solidcolour=arguments.colourmode == "solid", brightnessspeed=arguments.colourmode == "speed", centermass=arguments.colourmode == "centermass", dtype=listofparticles.positions.dtype, velocitydtype=listofparticles.velocities.dtype)
+        simulation.addCallback(renderer.callback, arguments.renderevery)
+    server = None
+    if arguments.serve:
+        from particleStream import StreamServer
+        host, separator, port = arguments.serve.rpartition(":")
+        server = StreamServer(host or "127.0.0.1", int(port), boundary, speedLimit).start()
+        logging.info("Main : Streaming frames on port %d", server.port)
+        simulation.addCallback(server.callback, arguments.serveevery)
+    # Outputs are closed and a checkpoint is written even if the run is interrupted or fails,
+    # the recorder is flushed first so the checkpoint is never ahead of the last recorded frame
+    # The clock is only checked between batches of frames
+    # Ctrl-C stops at the end of the current frame so the saved state is a whole frame
+    import signal
+    signal.signal(signal.SIGINT, lambda signum, stackframe: simulation.stop())
+    try:
+        while time.time() <= timeout and not simulation.stopping:
+            simulation.step(arguments.batch)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if analytics is not None:
+            analytics.close()
+        if server is not None:
+            server.stop()
+        if renderer is not None:
+            renderer.close()
+        closeEngine()
+        if arguments.checkpoint:
+            saveCheckpoint(arguments.checkpoint, simulation.listofparticles, simulation.frame, atomic.value)
+            logging.info("Main : Checkpoint saved to %s", arguments.checkpoint)
 
-            #print(particlepositions)
-            #time.sleep(1)
-            gravtimer += 1
-
-        if enteredGrav == True:
-            logging.info("Main : Gravity no longer effect")
-
-        #time.sleep(1)
-        gravtimer += 1
-
-        if time.time() > timeout:
-            break
-        
     print("Total collisions:", atomic.value)
+    metrics.close()
     logging.info("Main : End")
\ No newline at end of file
@@ -0,0 +1,188 @@
+import argparse
+import itertools
+import json
+import sys
+import numpy as np
+import particleCode
+
+# Ensemble mode, many independent simulations stepped as one batch
+# Members share the boundary but can differ in seed, speedLimit and numberofparticles.
+# State is stored along a leading batch axis, positions and velocities are (B, nmax, 2) where
+# nmax is the largest member. Rows past a member's particle count are padding: they are stepped
+# with everything else but never collide and are left out of every statistic.
+#
+# Movement and gravity run once over the flattened batch. Collision detection builds one key
+# per particle from (member, cell) so groups never span two members, and every member gets
+# exactly the trajectory it would have on its own.
+#
+# Example, three seeds at two speed limits:
+#   python particleEnsemble.py --seeds 0,1,2 --speedlimits 3,5 --particles 1000 --steps 500
+
+class Ensemble(object):
+    # members - list of dicts with any of "seed", "speedLimit" and "numberofparticles",
+    #           missing values come from the particleCode globals
+    def __init__(self, members, boundary=None, backend="numpy", compact=False, forcefield=None):
+        if len(members) == 0:
+            raise ValueError("an ensemble needs at least one member")
+        self.boundary = particleCode.boundary if boundary is None else boundary
+        self.backend = particleCode.createBackend(backend)
+        self.forcefield = forcefield
+        self.members = [dict(member) for member in members]
+        for member in self.members:
+            member.setdefault("seed", None)
+            member.setdefault("speedLimit", particleCode.speedLimit)
+            member.setdefault("numberofparticles", particleCode.numberofparticles)
+
+        self.counts = np.array([member["numberofparticles"] for member in self.members], dtype=np.int64)
+        nmax = int(self.counts.max())
+        if compact:
+            dtype, velocitydtype = particleCode.compactDtypes(self.boundary, max(member["speedLimit"] for member in self.members))
+        else:
+            dtype = velocitydtype = np.int64
+        self.positions = np.zeros((len(self.members), nmax, 2), dtype=dtype)
+        self.velocities = np.zeros((len(self.members), nmax, 2), dtype=velocitydtype)
+        self.active = np.arange(nmax)[None, :] < self.counts[:, None]
+
+        for index, member in enumerate(self.members):
+            particles = self.initialiseMember(member)
+            self.positions[index, :len(particles)] = particles.positions
+            self.velocities[index, :len(particles)] = particles.velocities
+
+        # Flat views for the kernels, the batch arrays are contiguous so these share memory
+        self.flatpositions = self.positions.reshape(-1, 2)
+        self.flatvelocities = self.velocities.reshape(-1, 2)
+        self.activeindices = np.flatnonzero(self.active.ravel())
+        self.memberof = self.activeindices // nmax
+
+        self.frame = 0
+        self.phase = None
+        self.collisions = np.zeros(len(self.members), dtype=np.int64)
+        self.lastcollisions = np.zeros(len(self.members), dtype=np.int64)
+
+    def initialiseMember(self, member):
+        # Same particles as a separate run with these globals, the globals are put back afterwards
+        saved = particleCode.boundary, particleCode.numberofparticles, particleCode.speedLimit, particleCode.compactstorage, particleCode.rng
+        try:
+            particleCode.boundary = self.boundary
+            particleCode.numberofparticles = member["numberofparticles"]
+            particleCode.speedLimit = member["speedLimit"]
+            particleCode.compactstorage = False
+            return particleCode.initialiseArray(member["seed"])
+        finally:
+            particleCode.boundary, particleCode.numberofparticles, particleCode.speedLimit, particleCode.compactstorage, particleCode.rng = saved
+
+    def __len__(self):
+        return len(self.members)
+
+    def member(self, index):
+        # A member's particles as a ParticleArray, views into the batch
+        count = int(self.counts[index])
+        return particleCode.ParticleArray.fromArrays(self.positions[index, :count], self.velocities[index, :count])
+
+    def move(self):
+        self.backend.moveParticles(self.flatpositions, self.flatvelocities, self.boundary)
+
+    def detect(self):
+        # Cells are numbered per member so members with the same cell never collide
+        positions = self.flatpositions[self.activeindices].astype(np.int64)
+        cellsper = (self.boundary + 1) * (self.boundary + 1)
+        keys = self.memberof * cellsper + positions[:, 0] * (self.boundary + 1) + positions[:, 1]
+        order, starts, counts = particleCode.groupRuns(keys)
+        return self.activeindices[order], starts, counts
+
+    def resolve(self, groups):
+        # Returns the number of collision groups of every member this frame
+        order, starts, counts = groups
+        self.backend.resolveCollisions(self.flatvelocities, order, starts, counts)
+        nmax = self.positions.shape[1]
+        self.lastcollisions = np.bincount(order[starts] // nmax, minlength=len(self.members))
+        self.collisions += self.lastcollisions
+        return self.lastcollisions
+
+    def gravity(self):
+        field = self.forcefield if self.forcefield is not None else particleCode.forcefield
+        if field.plain:
+            self.backend.haltParticles(self.flatpositions, self.boundary)
+        else:
+            field.apply(self.flatpositions, self.boundary)
+        self.lastcollisions = np.zeros(len(self.members), dtype=np.int64)
+
+    def movementStep(self):
+        self.move()
+        self.resolve(self.detect())
+
+    def step(self, n=1, schedule=None):
+        # Advances every member n frames through the schedule, see particleCode.Schedule
+        # Only the "movement" and "gravity" phases have batched versions
+        if schedule is None:
+            schedule = particleCode.defaultschedule
+        methods = {"movement": self.movementStep, "gravity": self.gravity}
+        target = self.frame + n
+        while self.frame < target:
+            name, end = schedule.phaseAt(self.frame)
+            if name not in methods:
+                raise ValueError("phase %r has no ensemble version" % name)
+            self.phase = name
+            stop = target if end is None else min(end, target)
+            method = methods[name]
+            for frame in range(stop - self.frame):
+                method()
+            self.frame = stop
+        return self.collisions
+
+    def statistics(self):
+        # One dict per member, all values are plain Python numbers so they serialise to JSON
+        weights = self.active[:, :, None]
+        count = np.maximum(self.counts, 1)[:, None]
+        velocities = np.where(weights, self.velocities, 0).astype(np.int64)
+        positions = np.where(weights, self.positions, 0).astype(np.int64)
+        energy = 0.5 * (velocities * velocities).sum(axis=1)
+        speed = np.sqrt((velocities * velocities).sum(axis=2)).sum(axis=1) / count[:, 0]
+        centre = positions.sum(axis=1) / count
+        momentum = velocities.sum(axis=1)
+
+        results = []
+        for index, member in enumerate(self.members):
+            results.append({
+                "member": index,
+                "seed": member["seed"],
+                "speedLimit": member["speedLimit"],
+                "numberofparticles": member["numberofparticles"],
+                "frames": self.frame,
+                "collisions": int(self.collisions[index]),
+                "collisionrate": float(self.collisions[index]) / self.frame if self.frame else 0.0,
+                "kineticenergy": float(energy[index].sum()),
+                "kineticenergyx": float(energy[index, 0]),
+                "kineticenergyy": float(energy[index, 1]),
+                "meanspeed": float(speed[index]),
+                "momentum": [int(value) for value in momentum[index]],
+                "centre": [float(value) for value in centre[index]],
+            })
+        return results
+
+def integerList(text):
+    return [int(value) for value in text.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every combination of seed, speed limit and particle count as one batch")
+    parser.add_argument("--seeds", type=integerList, default=[0], help="comma separated seeds")
+    parser.add_argument("--speedlimits", type=integerList, default=[particleCode.speedLimit], help="comma separated speed limits")
+    parser.add_argument("--particles", type=integerList, default=[particleCode.numberofparticles], help="comma separated particle counts")
+    parser.add_argument("--boundary", type=int, default=particleCode.boundary)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--backend", choices=sorted(particleCode.backends), default="numpy")
+    parser.add_argument("--compact", action="store_true", help="narrowest safe integer storage")
+    parser.add_argument("--output", default=None, help="JSON lines file, defaults to stdout")
+    arguments = parser.parse_args()
+
+    members = [{"seed": seed, "speedLimit": speedlimit, "numberofparticles": count} for seed, speedlimit, count in itertools.product(arguments.seeds, arguments.speedlimits, arguments.particles)]
+    ensemble = Ensemble(members, arguments.boundary, arguments.backend, arguments.compact)
+    ensemble.step(arguments.steps)
+
+    output = open(arguments.output, "a") if arguments.output else sys.stdout
+    try:
+        for result in ensemble.statistics():
+            output.write(json.dumps(result) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,132 @@
+import numpy as np
+from particleCode import expandRanges
+
+# Cell-list spatial index over the boundary grid
+# Particles are bucketed into square blocks of cellsize x cellsize cells and kept sorted by
+# (block, particle index) in one order array, cells[order] is the matching sorted block numbers.
+# Only occupied blocks appear anywhere, so memory and time follow the particle count and not
+# the size of the grid. A block's run of the order array is found by binary search.
+# With cellsize 1 the blocks are the collision cells and collisionGroups() gives exactly what
+# particleCode.findCollisionGroups does, larger blocks suit neighbourhood queries and density.
+#
+# rebuild() is a radix sort, one stable 16 bit pass per 16 bits of block number, each linear in
+# the number of particles.
+# update() only touches particles that changed block: they are taken out of the sorted keys and
+# merged back in at their new place. When many particles moved it falls back to rebuild().
+# The index keeps its own copy of the positions it was built from, so queries stay consistent
+# with the sorted order even after the caller's arrays move on.
+#
+# Queries are batched, every query returns (query number, particle index) pairs:
+#   radiusQuery(centres, radius) - particles within radius of each centre
+#   boxQuery(lows, highs)        - particles inside each [low, high] box, inclusive
+# A negative radius or a box with low above high on either axis matches nothing.
+
+class CellIndex(object):
+    # rebuildfraction - update() rebuilds instead when more than this fraction changed block
+    def __init__(self, boundary, cellsize=1, rebuildfraction=0.25):
+        self.boundary = boundary
+        self.cellsize = max(1, int(cellsize))
+        self.gridwidth = boundary // self.cellsize + 1
+        self.cellcount = self.gridwidth * self.gridwidth
+        self.rebuildfraction = rebuildfraction
+        self.positions = None
+        self.cells = None
+        self.order = np.zeros(0, dtype=np.int64)
+        self.sortedcells = np.zeros(0, dtype=np.int64)
+        self.rebuilds = 0
+        self.updates = 0
+
+    def cellsOf(self, positions):
+        blocks = (positions // self.cellsize).astype(np.int64)
+        return blocks[:, 0] * self.gridwidth + blocks[:, 1]
+
+    def rebuild(self, positions, cells=None):
+        # cells - cellsOf(positions) when the caller already has it
+        self.positions = np.array(positions)
+        self.cells = self.cellsOf(positions) if cells is None else cells
+        # Stable radix passes from the low 16 bits up, particles stay in index order per block
+        order = np.argsort((self.cells & 0xFFFF).astype(np.uint16), kind="stable")
+        shift = 16
+        while self.cellcount > 1 << shift:
+            order = order[np.argsort((self.cells[order] >> shift & 0xFFFF).astype(np.uint16), kind="stable")]
+            shift += 16
+        self.order = order
+        self.sortedcells = self.cells[order]
+        self.rebuilds += 1
+        return self
+
+    def update(self, positions):
+        # Brings the index up to date with positions, rebuilding only when that is cheaper
+        if self.cells is None or len(self.cells) != len(positions):
+            return self.rebuild(positions)
+        cells = self.cellsOf(positions)
+        changed = np.flatnonzero(cells != self.cells)
+        numberofparticles = len(cells)
+        # The merge keys are block * numberofparticles + index, they have to fit in an int64
+        if len(changed) > self.rebuildfraction * numberofparticles or self.cellcount * numberofparticles >= 1 << 63:
+            return self.rebuild(positions, cells)
+        np.copyto(self.positions, positions)
+        if len(changed) == 0:
+            return self
+
+        # The sorted order is kept as (block, index) keys, the changed particles are dropped
+        # and merged back in at their new block
+        keep = np.ones(numberofparticles, dtype=bool)
+        keep[changed] = False
+        remaining = self.order[keep[self.order]]
+        remainingkeys = self.cells[remaining] * numberofparticles + remaining
+        insertkeys = cells[changed] * numberofparticles + changed
+        sortedinsert = np.argsort(insertkeys)
+        positionsin = np.searchsorted(remainingkeys, insertkeys[sortedinsert])
+        self.order = np.insert(remaining, positionsin, changed[sortedinsert])
+        self.cells = cells
+        self.sortedcells = cells[self.order]
+        self.updates += 1
+        return self
+
+    def members(self, cell):
+        start, stop = np.searchsorted(self.sortedcells, [cell, cell + 1])
+        return self.order[start:stop]
+
+    def density(self):
+        # Particles per block as a (gridwidth, gridwidth) grid, built on demand
+        return np.bincount(self.cells, minlength=self.cellcount).reshape(self.gridwidth, self.gridwidth)
+
+    def collisionGroups(self):
+        # (order, starts, counts) of every block holding two or more particles, the same layout
+        # as findCollisionGroups, and the same groups when cellsize is 1
+        sortedcells = self.sortedcells
+        runstarts = np.flatnonzero(np.concatenate(([True], sortedcells[1:] != sortedcells[:-1])))
+        runcounts = np.diff(np.append(runstarts, len(sortedcells)))
+        crowded = runcounts > 1
+        return self.order, runstarts[crowded], runcounts[crowded]
+
+    def candidates(self, lows, highs):
+        # (query, particle) for every particle in the blocks overlapping each [low, high] box
+        lows = np.clip(np.floor_divide(np.asarray(lows, dtype=np.float64), self.cellsize), 0, self.gridwidth - 1).astype(np.int64)
+        highs = np.clip(np.floor_divide(np.asarray(highs, dtype=np.float64), self.cellsize), 0, self.gridwidth - 1).astype(np.int64)
+        # One contiguous run of the order array per (query, block column)
+        # An inverted box covers no columns or no rows, so it matches nothing
+        query, column = expandRanges(lows[:, 0], highs[:, 0] + 1)
+        starts = np.searchsorted(self.sortedcells, column * self.gridwidth + lows[query, 1], side="left")
+        stops = np.searchsorted(self.sortedcells, column * self.gridwidth + highs[query, 1], side="right")
+        run, sortedposition = expandRanges(starts, stops)
+        return query[run], self.order[sortedposition]
+
+    def radiusQuery(self, centres, radius):
+        # radius is one value or one per centre, distances are Euclidean
+        centres = np.atleast_2d(np.asarray(centres, dtype=np.float64))
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(centres),))
+        query, particle = self.candidates(centres - radius[:, None], centres + radius[:, None])
+        offset = self.positions[particle] - centres[query]
+        # Clipping to the grid can turn a negative radius's inverted box back into a real one
+        inside = (np.einsum("ij,ij->i", offset, offset) <= radius[query] ** 2) & (radius[query] >= 0)
+        return query[inside], particle[inside]
+
+    def boxQuery(self, lows, highs):
+        lows = np.atleast_2d(np.asarray(lows))
+        highs = np.atleast_2d(np.asarray(highs))
+        query, particle = self.candidates(lows, highs)
+        points = self.positions[particle]
+        inside = ((points >= lows[query]) & (points <= highs[query])).all(axis=1)
+        return query[inside], particle[inside]
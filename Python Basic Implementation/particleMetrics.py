@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+
+# Instrumentation hooks for the simulation engines
+# Engines call count(), phase() and frame() on whatever metrics object they were given.
+# NullMetrics is the default and does nothing, so the hooks cost one method call when disabled.
+#
+# Metrics keeps one counter/timer slot per worker thread. A worker only ever writes its own slot
+# so no lock is taken on the hot path, the slots are summed once per frame in frame().
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+nullphase = NullPhase()
+
+class NullMetrics(object):
+    enabled = False
+
+    def count(self, name, amount=1):
+        pass
+
+    def phase(self, name):
+        return nullphase
+
+    def frame(self):
+        pass
+
+    def close(self):
+        pass
+
+class PhaseTimer(object):
+    __slots__ = ("_slot", "_name", "_start")
+
+    def __init__(self, slot, name):
+        self._slot = slot
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        phases = self._slot["phases"]
+        phases[self._name] = phases.get(self._name, 0.0) + time.perf_counter() - self._start
+        return False
+
+class Metrics(object):
+    enabled = True
+
+    # every    - only every nth frame is recorded and exported, 1 records them all
+    # path     - JSON lines file each recorded frame is appended to
+    # callback - called with each recorded frame's dict
+    def __init__(self, every=1, path=None, callback=None):
+        self.every = max(1, int(every))
+        self.callback = callback
+        self.frames = 0
+        self._file = open(path, "a") if path else None
+        self._local = threading.local()
+        self._slots = []
+        self._slotslock = threading.Lock()
+        self._sampling = True
+
+    def slot(self):
+        # Each thread registers its own slot once, the lock is only taken then
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            slot = {"worker": threading.current_thread().name, "counters": {}, "phases": {}}
+            with self._slotslock:
+                self._slots.append(slot)
+            self._local.slot = slot
+        return slot
+
+    def count(self, name, amount=1):
+        if self._sampling:
+            counters = self.slot()["counters"]
+            counters[name] = counters.get(name, 0) + amount
+
+    def phase(self, name):
+        if self._sampling:
+            return PhaseTimer(self.slot(), name)
+        return nullphase
+
+    def frame(self):
+        # Called by the engine between steps while no worker is writing
+        if self._sampling:
+            record = {"frame": self.frames, "time": time.time(), "counters": {}, "phases": {}, "workers": []}
+            with self._slotslock:
+                slots = list(self._slots)
+            for slot in slots:
+                if not slot["counters"] and not slot["phases"]:
+                    continue
+                for name, amount in slot["counters"].items():
+                    record["counters"][name] = record["counters"].get(name, 0) + amount
+                for name, seconds in slot["phases"].items():
+                    record["phases"][name] = record["phases"].get(name, 0.0) + seconds
+                record["workers"].append({"worker": slot["worker"], "counters": slot["counters"], "phases": slot["phases"]})
+                slot["counters"] = {}
+                slot["phases"] = {}
+            self.export(record)
+
+        self.frames += 1
+        self._sampling = self.frames % self.every == 0
+
+    def export(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+        if self.callback is not None:
+            self.callback(record)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
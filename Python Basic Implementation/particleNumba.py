@@ -0,0 +1,89 @@
+import numba
+import particleCode
+
+# JIT compiled kernel set, registered in particleCode as the "numba" backend
+# Importing this module raises ImportError without numba, createBackend("numba") passes that on.
+# The branchy per-particle logic (wall reflection and the pairwise velocity exchange) is written
+# as plain loops like updatePosition and checkPossibleCollisions, numba compiles them to machine code.
+# Kernels release the GIL so ThreadEngine slices run in parallel.
+# Collision detection is sort based and stays on the NumPy implementation.
+
+@numba.njit(cache=True, nogil=True)
+def moveKernel(positions, velocities, boundary):
+    for index in range(positions.shape[0]):
+        for axis in range(2):
+            updated = positions[index, axis] + velocities[index, axis]
+            if updated > boundary:
+                velocities[index, axis] = -velocities[index, axis]
+                updated = boundary - (updated - boundary)
+            elif updated < 0:
+                velocities[index, axis] = -velocities[index, axis]
+                updated = -updated
+            elif updated == boundary or updated == 0:
+                velocities[index, axis] = -velocities[index, axis]
+            positions[index, axis] = updated
+
+@numba.njit(cache=True, nogil=True)
+def haltKernel(positions, boundary):
+    for index in range(positions.shape[0]):
+        if positions[index, 0] > 0:
+            positions[index, 0] -= 1
+        else:
+            positions[index, 0] = boundary
+
+@numba.njit(cache=True, nogil=True)
+def resolveKernel(velocities, order, starts, counts):
+    # Same rules as particleCode.resolveCollisions, one group at a time
+    for group in range(starts.shape[0]):
+        start = starts[group]
+        count = counts[group]
+        for axis in range(2):
+            if count == 2:
+                first = order[start]
+                second = order[start + 1]
+                vel1 = velocities[first, axis]
+                vel2 = velocities[second, axis]
+                if vel1 == -vel2:
+                    velocities[first, axis] = -vel1
+                    velocities[second, axis] = -vel2
+                elif vel1 == 0 and vel2 != 0:
+                    velocities[first, axis] = vel2
+                    velocities[second, axis] = 0
+                elif vel1 != 0 and vel2 == 0:
+                    velocities[second, axis] = vel1
+                    velocities[first, axis] = 0
+                continue
+
+            momentum = 0
+            for member in range(count):
+                momentum += velocities[order[start + member], axis]
+            if momentum == 0:
+                for member in range(count):
+                    velocities[order[start + member], axis] = -velocities[order[start + member], axis]
+            else:
+                # Each particle takes the next one's velocity, the last takes the first's
+                head = velocities[order[start], axis]
+                for member in range(count - 1):
+                    velocities[order[start + member], axis] = velocities[order[start + member + 1], axis]
+                velocities[order[start + count - 1], axis] = head
+
+class NumbaBackend(object):
+    name = "numba"
+    findCollisionGroups = staticmethod(particleCode.findCollisionGroups)
+    findSweptCollisionGroups = staticmethod(particleCode.findSweptCollisionGroups)
+
+    @staticmethod
+    def moveParticles(positions, velocities, boundary):
+        moveKernel(positions, velocities, positions.dtype.type(boundary))
+        return positions
+
+    @staticmethod
+    def haltParticles(positions, boundary):
+        haltKernel(positions, positions.dtype.type(boundary))
+        return positions
+
+    @staticmethod
+    def resolveCollisions(velocities, order, starts, counts):
+        if len(starts) > 0:
+            resolveKernel(velocities, order, starts, counts)
+        return velocities
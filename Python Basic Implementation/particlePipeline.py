@@ -0,0 +1,116 @@
+import threading
+import time
+import numpy as np
+
+# Producer/consumer frame pipeline between the simulation and a viewer
+# The simulation runs on its own thread and publishes position/velocity snapshots into a small
+# ring of preallocated slots. The viewer only ever takes the latest completed frame, so a slow
+# simulation step never blocks input or display and a slow display never blocks the simulation.
+
+class Frame(object):
+    def __init__(self, numberofparticles, dtype):
+        self.positions = np.zeros((numberofparticles, 2), dtype=dtype)
+        self.velocities = np.zeros((numberofparticles, 2), dtype=dtype)
+        self.gravityhalt = False
+        self.step = -1
+
+class FrameRing(object):
+    # slots      - number of preallocated frames, 3 lets producer and consumer never wait on each other
+    # dropframes - True: the producer overwrites frames the viewer never took (viewer sees only the latest)
+    #              False: the producer waits until the viewer took the previous frame, nothing is skipped
+    def __init__(self, numberofparticles, dtype=np.int64, slots=3, dropframes=True):
+        if slots < 2:
+            raise ValueError("a frame ring needs at least two slots")
+        self.frames = [Frame(numberofparticles, dtype) for slot in range(slots)]
+        self.dropframes = dropframes
+        self.published = 0
+        self.dropped = 0
+        self._latest = None
+        self._held = None
+        self._taken = True
+        self._condition = threading.Condition()
+
+    def freeSlot(self):
+        for slot, frame in enumerate(self.frames):
+            if slot != self._latest and slot != self._held:
+                return slot
+        return None
+
+    def publish(self, positions, velocities, gravityhalt=False, step=0, timeout=None):
+        # Copies a snapshot into a slot nobody is reading and makes it the latest frame
+        # Returns False if the producer had to give up waiting for the viewer
+        with self._condition:
+            if not self.dropframes:
+                if not self._condition.wait_for(lambda: self._taken, timeout):
+                    return False
+            slot = self.freeSlot()
+            while slot is None:
+                # Only with two slots, the viewer holds one and the other is the latest
+                if not self._condition.wait(timeout):
+                    return False
+                slot = self.freeSlot()
+
+        # The slot is neither held nor latest so it can be filled without the lock
+        frame = self.frames[slot]
+        np.copyto(frame.positions, positions)
+        np.copyto(frame.velocities, velocities)
+        frame.gravityhalt = gravityhalt
+        frame.step = step
+
+        with self._condition:
+            if not self._taken:
+                self.dropped += 1
+            self._latest = slot
+            self._taken = False
+            self.published += 1
+            self._condition.notify_all()
+        return True
+
+    def hasNew(self):
+        return not self._taken
+
+    def acquire(self):
+        # Latest completed frame, held until the next acquire so the producer won't overwrite it
+        # None until the first frame is published
+        with self._condition:
+            if self._latest is None:
+                return None
+            self._held = self._latest
+            self._taken = True
+            self._condition.notify_all()
+            return self.frames[self._held]
+
+class SimulationProducer(threading.Thread):
+    # Runs stepfunction in a loop and publishes the result into the ring
+    # stepfunction() returns (listofparticles, gravityhalt) after advancing one step
+    # targetrate - steps per second to aim for, None runs as fast as possible
+    def __init__(self, ring, stepfunction, targetrate=None):
+        threading.Thread.__init__(self, name="simulation", daemon=True)
+        self.ring = ring
+        self.stepfunction = stepfunction
+        self.targetrate = targetrate
+        self.steps = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        nexttick = time.perf_counter()
+        while not self._stopped.is_set():
+            listofparticles, gravityhalt = self.stepfunction()
+            self.steps += 1
+            # Keep retrying so stop() is noticed while waiting on a viewer that doesn't drop frames
+            while not self.ring.publish(listofparticles.positions, listofparticles.velocities, gravityhalt, self.steps, timeout=0.1):
+                if self._stopped.is_set():
+                    return
+
+            if self.targetrate:
+                nexttick += 1.0 / self.targetrate
+                delay = nexttick - time.perf_counter()
+                if delay > 0:
+                    self._stopped.wait(delay)
+                else:
+                    # Running behind, don't try to catch up with a burst of steps
+                    nexttick = time.perf_counter()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,237 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from particleMetrics import NullMetrics
+import particleCode
+from particleCode import ParticleArray, createBackend
+
+# Multi-process engine with spatial domain decomposition
+# The particle state lives in shared memory and the boundary x boundary domain is split
+# into vertical strips along x, one strip per process.
+#
+# Each process owns the particles whose x lies in its strip. A step has three phases:
+#   move    - every process moves its own particles and hands back the ones that left its strip
+#   detect  - every process finds the collision groups among the particles now in its strip
+#   resolve - every process resolves the groups it found
+# The driver waits for every process between phases so no one reads a half-moved state.
+# A collision only happens between particles in the same cell and a cell belongs to exactly one
+# strip, so collisions on either side of a strip border are resolved by exactly one process.
+#
+# Every process keeps the sorted list of indices it owns, so a phase only touches its own
+# particles and costs O(N / P) rather than a scan of all N. Particles that cross a border
+# are returned to the driver with the strip they landed in, and the driver passes them on to
+# their new owner with the next command. A migrant is only merged in after the move finished,
+# so it can't be moved twice in the same step.
+
+def stripBounds(numberofprocesses, boundary):
+    # [start, stop) x range of each strip, the last one ends past boundary
+    return np.linspace(0, boundary + 1, numberofprocesses + 1).astype(np.int64)
+
+def stripOf(x, strips):
+    return (np.searchsorted(strips, x, side="right") - 1).astype(np.int32)
+
+def attachBlock(name):
+    # Children must not unlink the block when they exit, the engine owns it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def ownRows(own):
+    # A slice when the owned indices are one contiguous run, always the case with one process,
+    # so the kernels work on views instead of gathered copies
+    if len(own) > 0 and own[-1] - own[0] + 1 == len(own):
+        return slice(int(own[0]), int(own[-1]) + 1)
+    return own
+
+def processWorker(workerId, names, numberofparticles, dtype, velocitydtype, strips, boundary, backendname, forcefield, connection):
+    backend = createBackend(backendname)
+    halt = backend.haltParticles if forcefield.plain else forcefield.apply
+    blocks = [attachBlock(name) for name in names]
+    positions = np.ndarray((numberofparticles, 2), dtype=dtype, buffer=blocks[0].buf)
+    velocities = np.ndarray((numberofparticles, 2), dtype=velocitydtype, buffer=blocks[1].buf)
+    # The driver hands out the initial particles as migrants with the first command
+    own = np.zeros(0, dtype=np.int64)
+    groups = (np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+    while True:
+        command, incoming = connection.recv()
+        if len(incoming) > 0:
+            # Keep own ascending
+            incoming = np.sort(incoming)
+            own = np.insert(own, np.searchsorted(own, incoming), incoming)
+        if command == "move" or command == "gravity":
+            rows = ownRows(own)
+            ownpositions = positions[rows]
+            if command == "move":
+                ownvelocities = velocities[rows]
+                backend.moveParticles(ownpositions, ownvelocities, boundary)
+                if rows is own:
+                    velocities[own] = ownvelocities
+            else:
+                halt(ownpositions, boundary)
+            if rows is own:
+                positions[own] = ownpositions
+            moved = len(own)
+            if len(strips) == 2:
+                # A single strip covers the whole domain, nothing can leave it
+                connection.send((moved, own[:0], own[:0]))
+                continue
+            destinations = stripOf(ownpositions[:, 0], strips)
+            leaving = destinations != workerId
+            emigrants = own[leaving]
+            own = own[~leaving]
+            connection.send((moved, emigrants, destinations[leaving]))
+        elif command == "detect":
+            # own is ascending and the sort is stable, so groups keep the single-process order
+            order, starts, counts = backend.findCollisionGroups(positions[ownRows(own)], boundary)
+            groups = (own[order], starts, counts)
+            connection.send(len(starts))
+        elif command == "resolve":
+            backend.resolveCollisions(velocities, *groups)
+            connection.send(len(groups[1]))
+        elif command == "stop":
+            break
+
+    del positions, velocities
+    for block in blocks:
+        block.close()
+    connection.send(None)
+
+class ProcessEngine(object):
+    # Same step API as ThreadEngine so the __main__ loop and opengl.py use it unchanged
+    # The first call copies the particles into shared memory and returns the shared store,
+    # callers already keep the returned listofparticles so they carry on with the shared one
+    def __init__(self, numberofprocesses=None, boundary=511, metrics=None, collisionmode="cell", backendname="numpy", forcefield=None):
+        if numberofprocesses is None:
+            numberofprocesses = multiprocessing.cpu_count()
+        # A strip is at least one column wide
+        self.numberofprocesses = max(1, min(int(numberofprocesses), boundary + 1))
+        self.boundary = boundary
+        self.strips = stripBounds(self.numberofprocesses, boundary)
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.collisionmode = collisionmode
+        # Each process creates its own instance, the driver's is used for sweep mode
+        self.backendname = backendname
+        self.backend = createBackend(backendname)
+        # None follows particleCode.forcefield as it is when the particles are attached
+        self.forcefield = forcefield
+        self.previous = None
+        self.particles = None
+        self._blocks = []
+        self._processes = []
+        self._connections = []
+        self._incoming = []
+
+    def attach(self, listofparticles):
+        if listofparticles is self.particles:
+            return self.particles
+        self.close()
+
+        numberofparticles = len(listofparticles)
+        dtype = listofparticles.positions.dtype
+        velocitydtype = listofparticles.velocities.dtype
+        positionbytes = max(1, numberofparticles * 2 * dtype.itemsize)
+        velocitybytes = max(1, numberofparticles * 2 * velocitydtype.itemsize)
+        self._blocks = [shared_memory.SharedMemory(create=True, size=size) for size in (positionbytes, velocitybytes)]
+
+        positions = np.ndarray((numberofparticles, 2), dtype=dtype, buffer=self._blocks[0].buf)
+        velocities = np.ndarray((numberofparticles, 2), dtype=velocitydtype, buffer=self._blocks[1].buf)
+        positions[...] = listofparticles.positions
+        velocities[...] = listofparticles.velocities
+        self.particles = ParticleArray.fromArrays(positions, velocities)
+
+        names = [block.name for block in self._blocks]
+        # The only full scan, from here on ownership changes through migrants. Done here rather
+        # than in the workers, a worker that starts late would see particles already moved.
+        strip = stripOf(positions[:, 0], self.strips)
+        field = self.forcefield if self.forcefield is not None else particleCode.forcefield
+        for workerId in range(self.numberofprocesses):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=processWorker, args=(workerId, names, numberofparticles, dtype, velocitydtype, self.strips, self.boundary, self.backendname, field, child), daemon=True)
+            process.start()
+            self._processes.append(process)
+            self._connections.append(parent)
+            self._incoming.append(np.flatnonzero(strip == workerId))
+        return self.particles
+
+    def command(self, name, counter=None):
+        # Sends a phase to every process and waits for all of them, acts as the barrier between phases
+        # Each process replies with its own count which is recorded per process
+        # Migrants from the last move go out with the command to their new owner
+        for connection, incoming in zip(self._connections, self._incoming):
+            connection.send((name, incoming))
+        replies = [connection.recv() for connection in self._connections]
+        if name == "move" or name == "gravity":
+            emigrants = np.concatenate([reply[1] for reply in replies])
+            destinations = np.concatenate([reply[2] for reply in replies])
+            self._incoming = [emigrants[destinations == workerId] for workerId in range(len(self._connections))]
+            replies = [reply[0] for reply in replies]
+        else:
+            self._incoming = [incoming[:0] for incoming in self._incoming]
+        if counter is not None and self.metrics.enabled:
+            for workerId, reply in enumerate(replies):
+                self.metrics.count("%s.%d" % (counter, workerId), reply)
+            self.metrics.count(counter, sum(replies))
+        return sum(replies)
+
+    # Swept paths can cross a strip border and chain into groups spanning several strips,
+    # so in "sweep" mode detection and resolution run in this process on the shared arrays
+    # while the workers are idle. Movement and gravity stay distributed.
+    def move(self, particles, boundary):
+        with self.metrics.phase("movement"):
+            if self.collisionmode == "sweep":
+                self.previous = particles.positions.copy()
+            self.command("move", "moved")
+
+    def detect(self, particles, boundary):
+        # Groups stay inside the processes, only the count comes back
+        with self.metrics.phase("detection"):
+            if self.collisionmode == "sweep":
+                return self.backend.findSweptCollisionGroups(self.previous, particles.positions, boundary)
+            return self.command("detect")
+
+    def resolve(self, particles, groups):
+        with self.metrics.phase("resolution"):
+            if self.collisionmode == "sweep":
+                self.backend.resolveCollisions(particles.velocities, *groups)
+                self.metrics.count("collisions", len(groups[1]))
+                return len(groups[1])
+            return self.command("resolve", "collisions")
+
+    def gravity(self, particles, boundary):
+        with self.metrics.phase("gravity"):
+            self.command("gravity", "fallen")
+
+    def mainmovementandcollisions(self, atomic, listofparticles):
+        particles = self.attach(listofparticles)
+        self.move(particles, self.boundary)
+        groups = self.detect(particles, self.boundary)
+        atomic.add(self.resolve(particles, groups))
+        self.metrics.frame()
+        return particles
+
+    def gravstopmethod(self, listofparticles):
+        particles = self.attach(listofparticles)
+        self.gravity(particles, self.boundary)
+        self.metrics.frame()
+        return particles
+
+    def close(self):
+        # Copies the state back out so a closed engine's particles remain usable
+        if self.particles is not None:
+            self.particles.positions = self.particles.positions.copy()
+            self.particles.velocities = self.particles.velocities.copy()
+            self.particles = None
+        for connection in self._connections:
+            connection.send(("stop", np.zeros(0, dtype=np.int64)))
+            connection.recv()
+        for process in self._processes:
+            process.join()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+        self._processes = []
+        self._connections = []
+        self._incoming = []
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Array based rasteriser for the particle colour modes of opengl.py
+# No OpenGL in here so the same code can draw into any buffer, with or without a window.
+#
+# Colour modes (same as the keys in opengl.py):
+#   default         - red, blue while gravity is in effect
+#   solidcolour     - green
+#   brightnessspeed - green, brightness picked from the particle's velocities
+#   centermass      - only particles near the center, brighter towards the middle
+
+# Center mass radius is shrunk by this much, and brightness drops by it
+additionalradius = 30
+
+class FrameBuffer(object):
+    # Preallocated RGBA image reused for every frame, indexed [x][y][channel]
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.image = np.zeros((width, height, 4), dtype=np.ubyte)
+
+    def clear(self):
+        self.image.fill(0)
+
+def speedBrightness(velocities, brightness):
+    # Same branches as the original per-particle draw loop, evaluated with Python's and/or rules:
+    # "vx and vy == n" is true when vx is non-zero and vy == n
+    # "vx or vy == n" is true when vx is non-zero or vy == n
+    # Particles matching no branch keep the brightness they came in with
+    moving = velocities[:, 0] != 0
+    vy = velocities[:, 1]
+    conditions = [
+        moving & (vy == 1),
+        moving & (vy == 2),
+        moving & (vy == 3),
+        moving & (vy == 0),
+        moving | (vy == 3),
+        moving | (vy == 2),
+        moving | (vy == 1),
+    ]
+    return np.select(conditions, [120, 180, 255, 75, 220, 150, 90], brightness)
+
+def particleColours(positions, velocities, width, height, solidcolour=False, brightnessspeed=False, centermass=False, gravityhalt=False):
+    # Returns (visible, channel, brightness) for every particle
+    # visible is a boolean mask, channel the colour channel index and brightness one value per particle
+    channel = 2 if gravityhalt else 0
+    if solidcolour or brightnessspeed:
+        channel = 1
+
+    x = positions[:, 0]
+    y = positions[:, 1]
+    # Particles outside the buffer are culled
+    visible = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    brightness = np.full(len(positions), 255.0)
+
+    if centermass:
+        radius = height / 2
+        hypotenuse = np.hypot(height / 2 - x, width / 2 - y)
+        visible &= hypotenuse <= radius - additionalradius
+        brightness = 255 - (hypotenuse + additionalradius)
+
+    if brightnessspeed:
+        brightness = speedBrightness(velocities, brightness)
+
+    # Float brightness truncates like assigning it into the ubyte image did
+    brightness = np.clip(brightness, 0, 255).astype(np.ubyte)
+    return visible, channel, brightness
+
+def rasterize(framebuffer, positions, velocities, solidcolour=False, brightnessspeed=False, centermass=False, gravityhalt=False):
+    # Clears the buffer in place and scatters every visible particle into it
+    # When two particles share a pixel the later one wins, as in the original loop
+    # Repeated indices in one assignment have no defined winner, so only the last is written
+    framebuffer.clear()
+    visible, channel, brightness = particleColours(positions, velocities, framebuffer.width, framebuffer.height, solidcolour, brightnessspeed, centermass, gravityhalt)
+    shown = np.flatnonzero(visible)
+    pixels = np.ravel_multi_index((positions[shown, 0], positions[shown, 1]), framebuffer.image.shape[:2])
+    drawn, lastfromend = np.unique(pixels[::-1], return_index=True)
+    last = shown[len(shown) - 1 - lastfromend]
+    framebuffer.image[positions[last, 0], positions[last, 1], channel] = brightness[last]
+    return framebuffer.image
@@ -0,0 +1,156 @@
+import queue
+import struct
+import threading
+import numpy as np
+from particleCode import ParticleArray
+
+# Streaming trajectory recorder and memory-mapped reader
+#
+# File layout:
+#   64 byte header - magic, version, numberofparticles, boundary, dtype
+#   frames         - one after another, each frame is positions (n, 2) followed by velocities (n, 2)
+# The frame count is not stored, it follows from the file size so an interrupted recording is
+# still readable up to its last complete chunk.
+#
+# Frames are copied into a preallocated chunk and written one chunk at a time. With asynchronous
+# recording full chunks are handed to a writer thread so stepping never waits on the disk.
+
+magic = b"PTRJ"
+version = 1
+headerformat = "<4sIQq8s"
+headersize = 64
+
+def readHeader(path):
+    with open(path, "rb") as trajectory:
+        header = trajectory.read(headersize)
+    if len(header) < headersize or header[:4] != magic:
+        raise ValueError("%s is not a particle trajectory" % path)
+    filemagic, fileversion, numberofparticles, boundary, dtype = struct.unpack_from(headerformat, header)
+    if fileversion != version:
+        raise ValueError("unsupported trajectory version %d" % fileversion)
+    return numberofparticles, boundary, np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+
+class TrajectoryRecorder(object):
+    # chunkbytes   - most bytes in one chunk, frames per write follow from it so memory stays
+    #                bounded whatever the particle count (a chunk always holds at least one frame)
+    # chunkframes  - frames per write, overrides chunkbytes; without it small runs still write
+    #                every 64 frames so little is lost if they are interrupted
+    # asynchronous - write chunks from a background thread, which keeps three chunks allocated
+    def __init__(self, path, numberofparticles, boundary, dtype=np.int64, chunkbytes=16 << 20, chunkframes=None, asynchronous=True):
+        self.numberofparticles = numberofparticles
+        self.dtype = np.dtype(dtype)
+        if chunkframes is None:
+            framebytes = 4 * numberofparticles * self.dtype.itemsize
+            chunkframes = min(64, chunkbytes // framebytes) if framebytes else 64
+        self.chunkframes = max(1, int(chunkframes))
+        self.frames = 0
+        self._file = open(path, "wb")
+        header = struct.pack(headerformat, magic, version, numberofparticles, boundary, self.dtype.str.encode("ascii"))
+        self._file.write(header.ljust(headersize, b"\0"))
+
+        # Two chunks are enough for double buffering, a third lets the writer lag a little
+        self._free = queue.Queue()
+        for chunk in range(3 if asynchronous else 1):
+            self._free.put(np.empty((self.chunkframes, 2, numberofparticles, 2), dtype=self.dtype))
+        self._chunk = self._free.get()
+        self._filled = 0
+
+        self._pending = None
+        self._writer = None
+        self._error = None
+        if asynchronous:
+            self._pending = queue.Queue()
+            self._writer = threading.Thread(target=self.writeLoop, name="recorder", daemon=True)
+            self._writer.start()
+
+    def record(self, particles):
+        # Appends the current positions and velocities as the next frame
+        self._chunk[self._filled, 0] = particles.positions
+        self._chunk[self._filled, 1] = particles.velocities
+        self._filled += 1
+        self.frames += 1
+        if self._filled == self.chunkframes:
+            self.flush()
+
+    def flush(self):
+        if self._filled == 0:
+            return
+        if self._writer is None:
+            self._file.write(self._chunk[:self._filled].tobytes())
+            self._filled = 0
+            return
+        if self._error is not None:
+            raise self._error
+        self._pending.put((self._chunk, self._filled))
+        # Blocks only if the writer has fallen a whole ring of chunks behind
+        self._chunk = self._free.get()
+        self._filled = 0
+
+    def writeLoop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            chunk, filled = item
+            try:
+                self._file.write(chunk[:filled].tobytes())
+            except OSError as error:
+                self._error = error
+            self._free.put(chunk)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+        self._file.close()
+        self._file = None
+        if self._error is not None:
+            raise self._error
+
+class TrajectoryReader(object):
+    # Memory-maps a recording, frames are only read from disk when they are touched
+    def __init__(self, path):
+        self.numberofparticles, self.boundary, self.dtype = readHeader(path)
+        framebytes = 4 * self.numberofparticles * self.dtype.itemsize
+        with open(path, "rb") as trajectory:
+            trajectory.seek(0, 2)
+            size = trajectory.tell()
+        self.frames = (size - headersize) // framebytes if framebytes else 0
+        self._data = None
+        if self.frames > 0:
+            self._data = np.memmap(path, dtype=self.dtype, mode="r", offset=headersize, shape=(self.frames, 2, self.numberofparticles, 2))
+
+    def __len__(self):
+        return self.frames
+
+    def frame(self, index):
+        # (positions, velocities) of one frame, read-only views into the mapping
+        if index < 0:
+            index += self.frames
+        if not 0 <= index < self.frames:
+            raise IndexError("frame %d out of range for %d frames" % (index, self.frames))
+        return self._data[index, 0], self._data[index, 1]
+
+class TrajectoryReplay(object):
+    # Plays a recording back through the same (listofparticles, gravityhalt) step interface
+    # as the live simulation, so it can drive a SimulationProducer
+    def __init__(self, reader, loop=True):
+        self.reader = reader
+        self.loop = loop
+        self.current = 0
+        self.paused = False
+
+    def seek(self, index):
+        self.current = min(max(0, index), len(self.reader) - 1)
+
+    def step(self):
+        positions, velocities = self.reader.frame(self.current)
+        if not self.paused:
+            if self.current + 1 < len(self.reader):
+                self.current += 1
+            elif self.loop:
+                self.current = 0
+        return ParticleArray.fromArrays(positions, velocities), False
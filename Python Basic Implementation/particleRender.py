@@ -0,0 +1,134 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from particleRaster import FrameBuffer, rasterize
+
+# Headless batch renderer, turns frames into image files without a window, display or GPU
+# Uses the same rasterize() as opengl.py, so the solid, brightness-speed and center-mass modes
+# look exactly like the window.
+#
+# submit() copies the frame into a preallocated slot and returns, a thread pool rasterizes and
+# writes it while stepping carries on. There are twice as many slots as workers, if all of them
+# are busy submit() waits for one rather than letting memory grow.
+#
+# Formats:
+#   png - one file per frame, frame000000.png ...
+#   ppm - one binary P6 file per frame
+#   raw - every frame appended to frames.rgb as packed RGB, ready for
+#         ffmpeg -f rawvideo -pixel_format rgb24 -video_size WxH -i frames.rgb
+# Images are written top row first as they appear in the window, which draws image[x][y]
+# with x as the row counted from the bottom.
+
+formats = ("png", "ppm", "raw")
+
+def pixelRows(image):
+    # RGB rows, top of the window first
+    return np.ascontiguousarray(image[::-1, :, :3])
+
+def encodePng(rows, compresslevel=1):
+    height, width = rows.shape[:2]
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    # Every scanline starts with filter type 0
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.ubyte)
+    scanlines[:, 1:] = rows.reshape(height, width * 3)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join((b"\x89PNG\r\n\x1a\n", chunk(b"IHDR", header), chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compresslevel)), chunk(b"IEND", b"")))
+
+def encodePpm(rows):
+    height, width = rows.shape[:2]
+    return b"P6\n%d %d\n255\n" % (width, height) + rows.tobytes()
+
+class RenderSlot(object):
+    def __init__(self, numberofparticles, width, height, dtype, velocitydtype):
+        self.positions = np.zeros((numberofparticles, 2), dtype=dtype)
+        self.velocities = np.zeros((numberofparticles, 2), dtype=velocitydtype)
+        self.framebuffer = FrameBuffer(width, height)
+        self.gravityhalt = False
+        self.index = 0
+
+class OffscreenRenderer(object):
+    # directory - where frames are written, created if missing
+    # workers   - rasterizing and encoding threads, zlib and most of numpy release the GIL
+    # colour modes match the keys of opengl.py
+    def __init__(self, directory, numberofparticles, width=512, height=512, imageformat="png", workers=None, solidcolour=False, brightnessspeed=False, centermass=False, dtype=np.int64, velocitydtype=None, compresslevel=1):
+        if imageformat not in formats:
+            raise ValueError("unknown image format %r, expected one of %s" % (imageformat, ", ".join(formats)))
+        if velocitydtype is None:
+            velocitydtype = dtype
+        self.directory = directory
+        self.width = width
+        self.height = height
+        self.imageformat = imageformat
+        self.solidcolour = solidcolour
+        self.brightnessspeed = brightnessspeed
+        self.centermass = centermass
+        self.compresslevel = compresslevel
+        self.workers = workers or os.cpu_count() or 1
+        self.frames = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._free = queue.Queue()
+        for slot in range(2 * self.workers):
+            self._free.put(RenderSlot(numberofparticles, width, height, dtype, velocitydtype))
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+        self._pending = []
+        self._rawfile = None
+        self._rawlock = threading.Lock()
+        if imageformat == "raw":
+            self._rawfile = open(os.path.join(directory, "frames.rgb"), "wb")
+
+    def submit(self, positions, velocities, gravityhalt=False):
+        # Queues one frame, returns its index
+        slot = self._free.get()
+        np.copyto(slot.positions, positions)
+        np.copyto(slot.velocities, velocities)
+        slot.gravityhalt = gravityhalt
+        slot.index = self.frames
+        self.frames += 1
+        # Errors from finished frames surface on the next submit
+        pending = []
+        for future in self._pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        pending.append(self._pool.submit(self.render, slot))
+        self._pending = pending
+        return slot.index
+
+    def callback(self, simulation):
+        # For Simulation.addCallback
+        self.submit(simulation.listofparticles.positions, simulation.listofparticles.velocities, simulation.gravityhalt)
+
+    def render(self, slot):
+        try:
+            image = rasterize(slot.framebuffer, slot.positions, slot.velocities, self.solidcolour, self.brightnessspeed, self.centermass, slot.gravityhalt)
+            rows = pixelRows(image)
+            if self.imageformat == "raw":
+                # Frames land at their own offset, so the file is in order whichever worker finishes first
+                # The lock keeps each seek together with its write, os.pwrite would need Unix
+                data = rows.tobytes()
+                with self._rawlock:
+                    self._rawfile.seek(slot.index * rows.nbytes)
+                    self._rawfile.write(data)
+            else:
+                data = encodePng(rows, self.compresslevel) if self.imageformat == "png" else encodePpm(rows)
+                with open(os.path.join(self.directory, "frame%06d.%s" % (slot.index, self.imageformat)), "wb") as output:
+                    output.write(data)
+        finally:
+            self._free.put(slot)
+
+    def close(self):
+        # Waits for every queued frame, raises the first error a worker hit
+        self._pool.shutdown(wait=True)
+        if self._rawfile is not None:
+            self._rawfile.close()
+            self._rawfile = None
+        for future in self._pending:
+            future.result()
+        self._pending = []
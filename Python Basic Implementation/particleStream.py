@@ -0,0 +1,320 @@
+import asyncio
+import base64
+import hashlib
+import struct
+import threading
+import numpy as np
+from particleCode import compactDtypes
+
+# Streams frames from the stepping loop to any number of remote viewers
+# One asyncio server accepts plain TCP and WebSocket clients on the same port, a connection
+# that opens with an HTTP GET is upgraded to a WebSocket, anything else is treated as TCP.
+#
+# Every message is one frame:
+#   header  - magic, kind, step, numberofparticles, count, keyframe step, position and velocity dtypes
+#   keyframe (kind 0) - every particle's position and velocity
+#   delta    (kind 1) - indices of the particles whose cell differs from the keyframe,
+#                       followed by their positions and velocities
+# Deltas are relative to the last keyframe rather than the previous frame, so a client can skip
+# any number of deltas and still rebuild the newest frame from its keyframe.
+# Particles that kept their cell keep their keyframe velocity on the client until the next keyframe.
+# On TCP every message is prefixed with its length (little endian uint32), on a WebSocket every
+# message is one binary frame.
+#
+# Slow clients never block the simulation: publish() only encodes and hands the message to the
+# event loop. Each client just keeps the newest keyframe and delta, whatever it didn't get to
+# send in time is replaced by the next frame.
+
+framemagic = b"PTFR"
+# magic, kind, step, numberofparticles, count, keyframe step, position dtype, velocity dtype
+frameheaderformat = "<4sBqIIq3s3s"
+frameheadersize = struct.calcsize(frameheaderformat)
+keyframe = 0
+deltaframe = 1
+
+websocketguid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def encodeFrame(kind, step, keystep, numberofparticles, indices, positions, velocities):
+    # positions and velocities are already converted to the wire dtypes
+    header = struct.pack(frameheaderformat, framemagic, kind, step, numberofparticles, len(positions), keystep, positions.dtype.str.encode("ascii"), velocities.dtype.str.encode("ascii"))
+    parts = [header]
+    if kind == deltaframe:
+        parts.append(indices.astype("<u4").tobytes())
+    parts.append(positions.tobytes())
+    parts.append(velocities.tobytes())
+    return b"".join(parts)
+
+def decodeFrame(message):
+    # Returns (kind, step, keystep, numberofparticles, indices, positions, velocities)
+    # indices is None for a keyframe
+    magic, kind, step, numberofparticles, count, keystep, positiontype, velocitytype = struct.unpack_from(frameheaderformat, message)
+    if magic != framemagic:
+        raise ValueError("not a particle frame")
+    positiondtype = np.dtype(positiontype.decode("ascii"))
+    velocitydtype = np.dtype(velocitytype.decode("ascii"))
+    offset = frameheadersize
+    indices = None
+    if kind == deltaframe:
+        indices = np.frombuffer(message, dtype="<u4", count=count, offset=offset)
+        offset += 4 * count
+    positions = np.frombuffer(message, dtype=positiondtype, count=2 * count, offset=offset).reshape(count, 2)
+    offset += positions.nbytes
+    velocities = np.frombuffer(message, dtype=velocitydtype, count=2 * count, offset=offset).reshape(count, 2)
+    return kind, step, keystep, numberofparticles, indices, positions, velocities
+
+class FrameEncoder(object):
+    # Turns successive frames into keyframe and delta messages
+    # keyframeevery - frames between full keyframes
+    def __init__(self, boundary, speedLimit, keyframeevery=30):
+        self.positiondtype, self.velocitydtype = (np.dtype(dtype).newbyteorder("<") for dtype in compactDtypes(boundary, speedLimit))
+        self.keyframeevery = max(1, int(keyframeevery))
+        self.keypositions = None
+        self.keystep = None
+        self.frames = 0
+
+    def encode(self, step, positions, velocities):
+        # Returns (kind, message)
+        if self.keypositions is None or len(self.keypositions) != len(positions) or self.frames % self.keyframeevery == 0:
+            self.keypositions = positions.copy()
+            self.keystep = step
+            kind = keyframe
+            message = encodeFrame(keyframe, step, step, len(positions), None, positions.astype(self.positiondtype), velocities.astype(self.velocitydtype))
+        else:
+            changed = np.flatnonzero((positions != self.keypositions).any(axis=1))
+            kind = deltaframe
+            message = encodeFrame(deltaframe, step, self.keystep, len(positions), changed, positions[changed].astype(self.positiondtype), velocities[changed].astype(self.velocitydtype))
+        self.frames += 1
+        return kind, message
+
+class StreamClientState(object):
+    # Server side state of one connection
+    def __init__(self, writer, websocket):
+        self.writer = writer
+        self.websocket = websocket
+        self.keystep = None
+        self.sentstep = None
+        self.wake = asyncio.Event()
+
+class StreamServer(object):
+    # host, port     - where to listen, port 0 picks a free port (see self.port once started)
+    # boundary, speedLimit - pick the wire dtypes
+    # keyframeevery  - frames between keyframes
+    def __init__(self, host="127.0.0.1", port=8765, boundary=511, speedLimit=3, keyframeevery=30):
+        self.host = host
+        self.port = port
+        self.encoder = FrameEncoder(boundary, speedLimit, keyframeevery)
+        self.clients = set()
+        self.published = 0
+        self._handlers = set()
+        self._keymessage = None
+        self._keystep = None
+        self._deltamessage = None
+        self._deltastep = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    # Running the server
+    def start(self):
+        # Runs the event loop on a daemon thread, returns once the server is listening
+        self._thread = threading.Thread(target=self.runLoop, name="stream", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def runLoop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self.listen())
+        self._started.set()
+        self._loop.run_forever()
+
+    async def listen(self):
+        # Can also be awaited directly on an existing loop instead of calling start()
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self.handleClient, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self._loop).result()
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+        self._loop = None
+
+    async def shutdown(self):
+        self._server.close()
+        # Aborting a connection ends its handler's read loop even if a slow client left unsent
+        # data behind, then wait for the handlers so nothing is left pending
+        handlers = list(self._handlers)
+        for client in list(self.clients):
+            client.writer.transport.abort()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    # Publishing, called from the simulation thread
+    def publish(self, step, positions, velocities):
+        kind, message = self.encoder.encode(step, positions, velocities)
+        self.published += 1
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.deliver, kind, step, message)
+
+    def callback(self, simulation):
+        # For Simulation.addCallback
+        self.publish(simulation.frame, simulation.listofparticles.positions, simulation.listofparticles.velocities)
+
+    def deliver(self, kind, step, message):
+        # Runs on the event loop, only swaps references so it never waits on a client
+        if kind == keyframe:
+            self._keymessage, self._keystep = message, step
+            self._deltamessage, self._deltastep = None, None
+        else:
+            self._deltamessage, self._deltastep = message, step
+        for client in self.clients:
+            client.wake.set()
+
+    # Connections
+    async def handleClient(self, reader, writer):
+        websocket = False
+        try:
+            first = await reader.readexactly(4)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        if first == b"GET ":
+            websocket = await self.upgrade(reader, writer)
+            if not websocket:
+                writer.close()
+                return
+
+        client = StreamClientState(writer, websocket)
+        self.clients.add(client)
+        self._handlers.add(asyncio.current_task())
+        client.wake.set()
+        sender = asyncio.ensure_future(self.sendLoop(client))
+        try:
+            # Incoming data is only read to notice the client going away
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                if websocket and data[0] & 0x0F == 0x8:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            self._handlers.discard(asyncio.current_task())
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            writer.close()
+
+    async def upgrade(self, reader, writer):
+        # Minimal RFC 6455 handshake, enough for browsers and websocket client libraries
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return False
+        key = None
+        for line in request.split(b"\r\n"):
+            name, separator, value = line.partition(b":")
+            if separator and name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + websocketguid).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def sendLoop(self, client):
+        try:
+            while True:
+                await client.wake.wait()
+                client.wake.clear()
+                # A client that missed a keyframe gets the newest one before any delta
+                if self._keymessage is not None and client.keystep != self._keystep:
+                    client.keystep = self._keystep
+                    client.sentstep = self._keystep
+                    await self.send(client, self._keymessage)
+                if self._deltamessage is not None and client.keystep == self._keystep and client.sentstep != self._deltastep:
+                    client.sentstep = self._deltastep
+                    await self.send(client, self._deltamessage)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def send(self, client, message):
+        if client.websocket:
+            length = len(message)
+            if length < 126:
+                header = struct.pack("!BB", 0x82, length)
+            elif length < 65536:
+                header = struct.pack("!BBH", 0x82, 126, length)
+            else:
+                header = struct.pack("!BBQ", 0x82, 127, length)
+        else:
+            header = struct.pack("<I", len(message))
+        client.writer.write(header)
+        client.writer.write(message)
+        await client.writer.drain()
+
+class StreamClient(object):
+    # Plain TCP client that rebuilds frames from the stream, used as a viewer stand-in
+    # positions / velocities hold the newest frame once a keyframe has arrived
+    def __init__(self, host="127.0.0.1", port=8765):
+        self.host = host
+        self.port = port
+        self.positions = None
+        self.velocities = None
+        self.step = None
+        self.keyframes = 0
+        self.deltas = 0
+        self._keypositions = None
+        self._keyvelocities = None
+        self._keystep = None
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        # Anything that isn't "GET " selects the TCP protocol
+        self._writer.write(b"PTCP")
+        await self._writer.drain()
+
+    async def receive(self):
+        # Reads and applies one message, returns its step
+        length = struct.unpack("<I", await self._reader.readexactly(4))[0]
+        return self.apply(await self._reader.readexactly(length))
+
+    def apply(self, message):
+        kind, step, keystep, numberofparticles, indices, positions, velocities = decodeFrame(message)
+        if kind == keyframe:
+            self._keypositions = positions.astype(np.int64)
+            self._keyvelocities = velocities.astype(np.int64)
+            self._keystep = step
+            self.positions = self._keypositions.copy()
+            self.velocities = self._keyvelocities.copy()
+            self.keyframes += 1
+        else:
+            if keystep != self._keystep:
+                # The server always sends the keyframe first, so this only happens on a bad stream
+                raise ValueError("delta for keyframe %d without that keyframe" % keystep)
+            # Particles that didn't change cell keep their keyframe state
+            np.copyto(self.positions, self._keypositions)
+            np.copyto(self.velocities, self._keyvelocities)
+            self.positions[indices] = positions
+            self.velocities[indices] = velocities
+            self.deltas += 1
+        self.step = step
+        return step
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
@@ -0,0 +1,264 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from particleMetrics import NullMetrics
+import particleCode
+from particleCode import ParticleArray, createBackend
+
+# Out-of-core stepping for particle sets larger than memory
+# The particle store is two memory-mapped files and every phase streams through them one tile
+# (a contiguous run of particles) at a time, so only a tile's worth of state is resident.
+#
+# Movement, wall bounce and gravity only touch their own particle so they run tile by tile.
+# Collision detection can't look at one tile, particles sharing a cell can sit anywhere in the
+# files, so it partitions by cell range instead of building one global index:
+#   1. a histogram of cell keys (x * (boundary + 1) + y) picks band edges so each band holds
+#      about tilesize particles, wherever they are clustered
+#   2. every tile appends the indices of its particles to the spill file of their band
+#   3. each band is loaded on its own, grouped with findCollisionGroups and resolved
+# A cell lies in exactly one band and indices are spilled in ascending order, so the groups and
+# their member order are exactly those of the in-memory path.
+# A band holds at most twice tilesize particles, unless a single cell holds more than that.
+
+positionsfile = "positions.dat"
+velocitiesfile = "velocities.dat"
+
+def openMappedParticles(directory, numberofparticles, dtype=np.int64, velocitydtype=None, mode="r+"):
+    # A ParticleArray whose arrays are memory-mapped files in directory
+    # mode "w+" creates the files, "r+" opens existing ones
+    if velocitydtype is None:
+        velocitydtype = dtype
+    positions = np.memmap(os.path.join(directory, positionsfile), dtype=dtype, mode=mode, shape=(numberofparticles, 2))
+    velocities = np.memmap(os.path.join(directory, velocitiesfile), dtype=velocitydtype, mode=mode, shape=(numberofparticles, 2))
+    return ParticleArray.fromArrays(positions, velocities)
+
+def mapParticles(listofparticles, directory, tilesize=1 << 20):
+    # Copies an in-memory store into mapped files
+    mapped = openMappedParticles(directory, len(listofparticles), listofparticles.positions.dtype, listofparticles.velocities.dtype, "w+")
+    for start in range(0, len(listofparticles), tilesize):
+        mapped.positions[start:start + tilesize] = listofparticles.positions[start:start + tilesize]
+        mapped.velocities[start:start + tilesize] = listofparticles.velocities[start:start + tilesize]
+    return mapped
+
+# numpy's hypergeometric draw needs both populations below this
+hypergeometriclimit = 10 ** 9 - 1
+
+def splitSample(rng, first, second, sample):
+    # How many of sample cells drawn without replacement from first + second cells land in the first
+    # Populations too large for one hypergeometric draw are thinned instead: every cell is kept
+    # with a probability a little above sample / total, so the two sides are independent binomial
+    # draws, and the surplus is removed by a draw over the far smaller kept population.
+    # A uniform subset of a uniform subset is still uniform, so the count stays exact.
+    if first == 0 or sample == 0:
+        return 0
+    if second == 0:
+        return sample
+    if first <= hypergeometriclimit and second <= hypergeometriclimit:
+        return int(rng.hypergeometric(first, second, sample))
+    total = first + second
+    if sample > total // 2:
+        return first - splitSample(rng, first, second, total - sample)
+    keep = min(1.0, (sample + 4 * sample ** 0.5 + 16) / total)
+    while True:
+        keptfirst = int(rng.binomial(first, keep))
+        keptsecond = int(rng.binomial(second, keep))
+        if keptfirst + keptsecond >= sample:
+            break
+    return keptfirst - splitSample(rng, keptfirst, keptsecond, keptfirst + keptsecond - sample)
+
+def initialiseMapped(directory, numberofparticles, boundary, speedLimit, seed=None, tilesize=1 << 20, dtype=np.int64, velocitydtype=None):
+    # Same distribution as initialiseArray (unique cells in [0, boundary - 1), non-zero velocities)
+    # but generated one block of cells at a time straight into the mapped files.
+    # Each block draws how many of the remaining particles fall into it from a hypergeometric
+    # distribution (split by splitSample on large grids), which keeps the sample uniform and
+    # without replacement.
+    # Particles come out ordered by cell.
+    rng = np.random.default_rng(seed)
+    arrayBoundary = boundary - 1
+    cellcount = arrayBoundary * arrayBoundary
+    if numberofparticles > cellcount:
+        raise ValueError("%d particles do not fit in %d unique cells" % (numberofparticles, cellcount))
+
+    mapped = openMappedParticles(directory, numberofparticles, dtype, velocitydtype, "w+")
+    blockcells = max(tilesize, 1)
+    remaining = numberofparticles
+    written = 0
+    for blockstart in range(0, cellcount, blockcells):
+        if remaining == 0:
+            break
+        size = min(blockcells, cellcount - blockstart)
+        left = cellcount - blockstart
+        chosen = splitSample(rng, size, left - size, remaining)
+        cells = blockstart + np.sort(rng.choice(size, size=chosen, replace=False))
+
+        tile = slice(written, written + chosen)
+        mapped.positions[tile, 0], mapped.positions[tile, 1] = np.divmod(cells, arrayBoundary)
+        velocities = rng.integers(-speedLimit, speedLimit, size=(chosen, 2))
+        stationary = np.flatnonzero(~velocities.any(axis=1))
+        while len(stationary) > 0:
+            velocities[stationary] = rng.integers(-speedLimit, speedLimit, size=(len(stationary), 2))
+            stationary = stationary[~velocities[stationary].any(axis=1)]
+        mapped.velocities[tile] = velocities
+
+        written += chosen
+        remaining -= chosen
+    return mapped
+
+class TiledGroups(object):
+    # Result of TiledEngine.detect: one spill file of particle indices per band of cell keys,
+    # bands are the key ranges cut from the step's histogram by TiledEngine.bandEdges
+    def __init__(self, directory, bands):
+        self.directory = directory
+        self.bands = bands
+
+    def bandIndices(self, band):
+        path = os.path.join(self.directory, "band%d.idx" % band)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=np.int64)
+        return np.fromfile(path, dtype=np.int64)
+
+class TiledEngine(object):
+    # Same step API as ThreadEngine, for stores opened with openMappedParticles
+    # Works on in-memory stores too, which is how the results are compared
+    # tilesize - particles per tile, also sets the number of collision bands
+    # Only "cell" collision detection is supported out of core
+
+    # Coarse bins of the cell key histogram that sets the collision bands
+    histogrambins = 1 << 16
+
+    def __init__(self, boundary=511, tilesize=1 << 20, metrics=None, backend="numpy", scratch=None, forcefield=None):
+        self.boundary = boundary
+        self.tilesize = max(1, int(tilesize))
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.backend = createBackend(backend)
+        self.collisionmode = "cell"
+        self.forcefield = forcefield
+        self._scratch = tempfile.mkdtemp(prefix="particletiles", dir=scratch)
+
+    def attach(self, particles, directory=None):
+        # Moves an in-memory store onto disk, into the scratch directory unless one is given
+        # Files in the scratch directory are removed by close()
+        if directory is None:
+            directory = os.path.join(self._scratch, "store")
+            os.makedirs(directory, exist_ok=True)
+        return mapParticles(particles, directory, self.tilesize)
+
+    def tiles(self, length):
+        for start in range(0, length, self.tilesize):
+            yield start, min(start + self.tilesize, length)
+
+    def move(self, particles, boundary):
+        with self.metrics.phase("movement"):
+            for start, stop in self.tiles(len(particles)):
+                # Slices of a memmap are views, the kernel writes straight back to the mapping
+                self.backend.moveParticles(particles.positions[start:stop], particles.velocities[start:stop], boundary)
+                self.metrics.count("moved", stop - start)
+
+    def cellKeys(self, particles, start, stop, boundary):
+        positions = np.asarray(particles.positions[start:stop]).astype(np.int64)
+        return positions[:, 0] * (boundary + 1) + positions[:, 1]
+
+    def bandEdges(self, particles, boundary):
+        # First cell key of every band, from a histogram of this step's cell keys
+        # Keys are binned coarsely first, bins holding more than a tile are counted again per cell
+        cellcount = (boundary + 1) * (boundary + 1)
+        width = -(-cellcount // min(cellcount, self.histogrambins))
+        bins = -(-cellcount // width)
+        histogram = np.zeros(bins, dtype=np.int64)
+        for start, stop in self.tiles(len(particles)):
+            histogram += np.bincount(self.cellKeys(particles, start, stop, boundary) // width, minlength=bins)
+        overfull = np.flatnonzero(histogram > self.tilesize) if width > 1 else np.zeros(0, dtype=np.int64)
+
+        fine = np.zeros(len(overfull) * width, dtype=np.int64)
+        if len(overfull) > 0:
+            for start, stop in self.tiles(len(particles)):
+                keys = self.cellKeys(particles, start, stop, boundary)
+                slot = np.searchsorted(overfull, keys // width)
+                inside = overfull[np.minimum(slot, len(overfull) - 1)] == keys // width
+                fine += np.bincount(slot[inside] * width + keys[inside] % width, minlength=len(fine))
+
+        # Units are coarse bins, or single cells of the overfull bins, in key order
+        coarse = np.flatnonzero(histogram)
+        coarse = coarse[~np.isin(coarse, overfull)]
+        cells = np.flatnonzero(fine)
+        starts = np.concatenate((coarse * width, overfull[cells // width] * width + cells % width))
+        counts = np.concatenate((histogram[coarse], fine[cells]))
+        order = np.argsort(starts)
+        starts, counts = starts[order], counts[order]
+        # A unit goes to the band its first particle falls in, so a band overshoots by at most one unit
+        band = (np.cumsum(counts) - counts) // self.tilesize
+        first = np.flatnonzero(np.concatenate(([True], band[1:] != band[:-1]))) if len(band) > 0 else np.zeros(0, dtype=np.int64)
+        edges = starts[first]
+        if len(edges) > 0:
+            edges[0] = 0
+        return edges
+
+    def detect(self, particles, boundary):
+        with self.metrics.phase("detection"):
+            for name in os.listdir(self._scratch):
+                if name.endswith(".idx"):
+                    os.remove(os.path.join(self._scratch, name))
+            edges = self.bandEdges(particles, boundary)
+            spills = {}
+            try:
+                for start, stop in self.tiles(len(particles)):
+                    band = np.searchsorted(edges, self.cellKeys(particles, start, stop, boundary), side="right") - 1
+                    order = np.argsort(band, kind="stable")
+                    sortedbands = band[order]
+                    runs = np.flatnonzero(np.concatenate(([True], sortedbands[1:] != sortedbands[:-1], [True])))
+                    for first, last in zip(runs[:-1], runs[1:]):
+                        bandnumber = int(sortedbands[first])
+                        if bandnumber not in spills:
+                            spills[bandnumber] = open(os.path.join(self._scratch, "band%d.idx" % bandnumber), "ab")
+                        # The stable sort keeps each band's indices ascending
+                        (order[first:last].astype(np.int64) + start).tofile(spills[bandnumber])
+            finally:
+                for spill in spills.values():
+                    spill.close()
+            return TiledGroups(self._scratch, sorted(spills))
+
+    def resolve(self, particles, groups):
+        collisions = 0
+        with self.metrics.phase("resolution"):
+            for band in groups.bands:
+                indices = groups.bandIndices(band)
+                order, starts, counts = self.backend.findCollisionGroups(np.asarray(particles.positions[indices]), self.boundary)
+                if len(starts) == 0:
+                    continue
+                members = indices[order]
+                velocities = np.asarray(particles.velocities[members])
+                # Groups are renumbered against the gathered copy and written back in one go
+                self.backend.resolveCollisions(velocities, np.arange(len(members)), starts, counts)
+                particles.velocities[members] = velocities
+                collisions += len(starts)
+            self.metrics.count("collisions", collisions)
+        return collisions
+
+    def gravity(self, particles, boundary):
+        field = self.forcefield if self.forcefield is not None else particleCode.forcefield
+        halt = self.backend.haltParticles if field.plain else field.apply
+        with self.metrics.phase("gravity"):
+            for start, stop in self.tiles(len(particles)):
+                halt(particles.positions[start:stop], boundary)
+                self.metrics.count("fallen", stop - start)
+
+    def mainmovementandcollisions(self, atomic, listofparticles):
+        self.move(listofparticles, self.boundary)
+        groups = self.detect(listofparticles, self.boundary)
+        atomic.add(self.resolve(listofparticles, groups))
+        self.metrics.frame()
+        return listofparticles
+
+    def gravstopmethod(self, listofparticles):
+        self.gravity(listofparticles, self.boundary)
+        self.metrics.frame()
+        return listofparticles
+
+    def flush(self, particles):
+        for array in (particles.positions, particles.velocities):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def close(self):
+        shutil.rmtree(self._scratch, ignore_errors=True)
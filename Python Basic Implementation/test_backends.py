@@ -0,0 +1,17 @@
+import pytest
+import particleCode
+from particleBenchmark import runConformance
+
+@pytest.fixture(autouse=True)
+def restoreGlobals(monkeypatch):
+    # runConformance sets these module globals for the run
+    for name in ("boundary", "numberofparticles", "compactstorage"):
+        monkeypatch.setattr(particleCode, name, getattr(particleCode, name))
+
+@pytest.mark.parametrize("backendname", sorted(particleCode.backends))
+@pytest.mark.parametrize("collisionmode, compact", [("cell", False), ("sweep", False), ("cell", True)])
+def test_conformance(backendname, collisionmode, compact):
+    if backendname not in particleCode.availableBackends():
+        pytest.skip("%s backend is not available here" % backendname)
+    mismatches = runConformance(["numpy", backendname], 2000, 127, 50, 0, collisionmode, compact)
+    assert mismatches[backendname] is None
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from particleIndex import CellIndex
+
+def pairs(query, particle):
+    return sorted(zip(query.tolist(), particle.tolist()))
+
+@pytest.mark.parametrize("cellsize", [1, 8])
+def test_queriesMatchBruteForce(cellsize):
+    rng = np.random.default_rng(0)
+    boundary = 127
+    positions = rng.integers(0, boundary, size=(2000, 2))
+    index = CellIndex(boundary, cellsize).rebuild(positions)
+
+    # Includes inverted boxes, boxes reaching past the grid and negative radii
+    lows = rng.integers(-20, boundary + 20, size=(60, 2))
+    highs = lows + rng.integers(-30, 30, size=(60, 2))
+    inside = ((positions[None] >= lows[:, None]) & (positions[None] <= highs[:, None])).all(axis=2)
+    assert pairs(*index.boxQuery(lows, highs)) == pairs(*np.nonzero(inside))
+
+    centres = rng.integers(-20, boundary + 20, size=(60, 2))
+    radius = rng.uniform(-10, 20, size=60)
+    distances = np.hypot(*(positions[None] - centres[:, None]).transpose(2, 0, 1))
+    assert pairs(*index.radiusQuery(centres, radius)) == pairs(*np.nonzero(distances <= radius[:, None]))
+
+def test_invertedBoxMatchesNothing():
+    index = CellIndex(15).rebuild(np.array([[3, 3], [4, 4]]))
+    for lows, highs in (([[5, 5]], [[2, 2]]), ([[2, 5]], [[6, 2]])):
+        query, particle = index.boxQuery(lows, highs)
+        assert len(query) == 0 and len(particle) == 0
+    query, particle = index.radiusQuery([[3, 3]], -1)
+    assert len(query) == 0
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import particleCode
+from particleCode import AtomicCounter, ParticleArray, ThreadEngine
+from particleProcesses import ProcessEngine, stripBounds, stripOf
+
+@pytest.mark.parametrize("collisionmode", ["cell", "sweep"])
+def test_processesMatchThreads(monkeypatch, collisionmode):
+    # Three strips on a small crowded grid, so particles cross borders and collide next to them
+    boundary = 63
+    monkeypatch.setattr(particleCode, "boundary", boundary)
+    monkeypatch.setattr(particleCode, "numberofparticles", 1500)
+    initial = particleCode.initialiseArray(5)
+    reference = ParticleArray.fromArrays(initial.positions.copy(), initial.velocities.copy())
+    strips = stripBounds(3, boundary)
+    threadengine = ThreadEngine(1, collisionmode=collisionmode, backend="numpy")
+    processengine = ProcessEngine(3, boundary, collisionmode=collisionmode)
+    try:
+        particles = initial
+        threadcollisions = AtomicCounter()
+        processcollisions = AtomicCounter()
+        crossings = 0
+        for step in range(40):
+            before = stripOf(reference.positions[:, 0], strips)
+            if step % 10 == 9:
+                threadengine.gravstopmethod(reference)
+                particles = processengine.gravstopmethod(particles)
+            else:
+                threadengine.mainmovementandcollisions(threadcollisions, reference)
+                particles = processengine.mainmovementandcollisions(processcollisions, particles)
+            crossings += np.count_nonzero(stripOf(reference.positions[:, 0], strips) != before)
+            assert np.array_equal(particles.positions, reference.positions)
+            assert np.array_equal(particles.velocities, reference.velocities)
+        assert crossings > 0
+        assert threadcollisions.value > 0
+        assert processcollisions.value == threadcollisions.value
+    finally:
+        threadengine.close()
+        processengine.close()
@@ -0,0 +1,46 @@
+import numpy as np
+import particleCode
+from particleCode import AtomicCounter, ParticleArray, ThreadEngine
+from particleTiles import TiledEngine, initialiseMapped, splitSample
+
+def test_initialiseMappedLargeGrid(tmp_path):
+    # 40000 x 40000 is past the populations a single hypergeometric draw accepts
+    mapped = initialiseMapped(str(tmp_path), 1000, 40000, 3, seed=1)
+    positions = np.asarray(mapped.positions)
+    assert positions.min() >= 0 and positions.max() < 40000 - 1
+    assert len(np.unique(positions[:, 0] * 40000 + positions[:, 1])) == 1000
+    assert np.asarray(mapped.velocities).any(axis=1).all()
+
+def test_splitSampleLargePopulations():
+    rng = np.random.default_rng(0)
+    counts = [splitSample(rng, 3 * 10 ** 9, 10 ** 9, 1000) for draw in range(500)]
+    assert all(0 <= count <= 1000 for count in counts)
+    assert abs(np.mean(counts) - 750) < 5
+    assert splitSample(rng, 3 * 10 ** 9, 10 ** 9, 4 * 10 ** 9) == 3 * 10 ** 9
+
+def test_tiledMatchesInMemory(monkeypatch):
+    # Tiles and bands much smaller than the store, so particles and collision cells span many of both
+    monkeypatch.setattr(particleCode, "boundary", 127)
+    monkeypatch.setattr(particleCode, "numberofparticles", 5000)
+    initial = particleCode.initialiseArray(3)
+    reference = ParticleArray.fromArrays(initial.positions.copy(), initial.velocities.copy())
+    threadengine = ThreadEngine(1, collisionmode="cell", backend="numpy")
+    tiledengine = TiledEngine(127, tilesize=700)
+    try:
+        mapped = tiledengine.attach(initial)
+        threadcollisions = AtomicCounter()
+        tiledcollisions = AtomicCounter()
+        for step in range(60):
+            if step % 10 == 9:
+                threadengine.gravstopmethod(reference)
+                tiledengine.gravstopmethod(mapped)
+            else:
+                threadengine.mainmovementandcollisions(threadcollisions, reference)
+                tiledengine.mainmovementandcollisions(tiledcollisions, mapped)
+            assert np.array_equal(np.asarray(mapped.positions), reference.positions)
+            assert np.array_equal(np.asarray(mapped.velocities), reference.velocities)
+        assert threadcollisions.value > 0
+        assert tiledcollisions.value == threadcollisions.value
+    finally:
+        threadengine.close()
+        tiledengine.close()